@@ -0,0 +1,431 @@
+# encoding: utf-8
+"""
+Benchmarks for the cleanup and admin actions of ckanext-ogdchcommands.
+
+Synthetic data of a configurable size is generated in the database of a
+CKAN configuration (a local PostgreSQL instance with the CKAN and the
+ckanext-harvest tables), the filestore is a temporary directory and Solr
+is replaced by an in-process stand-in. Every action runs in its own
+process on fresh data: its wall time, peak RSS and the number of SQL
+statements it sends through SQLAlchemy are recorded.
+
+The cleanups delete everything they find in the database, not only the
+fixtures: the benchmark refuses to run against a database that holds
+any harvest sources, jobs, objects, packages or resources of its own.
+
+Usage:
+    python benchmarks/bench_cleanup.py -c /etc/ckan/default/test.ini \\
+        [--sources=10] [--jobs=20] [--objects=50] [--resources=1000] \\
+        [--files=1000] [--extras=1000] [--packages=1000] [--dryrun] \\
+        [--only=cleanup_harvestjobs] [--output=results.jsonl]
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_MARKER = 'ogdch-benchmark'
+EXTRA_KEY = 'ogdch_benchmark_key'
+
+ACTIONS = [
+    'cleanup_harvestjobs',
+    'cleanup_resources',
+    'cleanup_filestore',
+    'cleanup_package_extra',
+    'check_indexing',
+]
+
+
+class FakeSolrResults(object):
+
+    def __init__(self, docs, hits, next_cursor_mark):
+        self.docs = docs
+        self.hits = hits
+        self.nextCursorMark = next_cursor_mark
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class FakeSolr(object):
+    """
+    an in-process stand-in for the Solr connection of CKAN: it keeps the
+    documents by id and supports the cursorMark paging of the actions
+    """
+
+    def __init__(self, docs=None):
+        self.docs = dict((doc['id'], doc) for doc in docs or [])
+        self.commits = 0
+
+    def search(self, q='*:*', rows=10, start=0, cursorMark=None, **kwargs):
+        docs = [self.docs[id] for id in sorted(self.docs)]
+        if cursorMark is not None:
+            start = 0 if cursorMark == '*' else int(cursorMark)
+        page = docs[start:start + int(rows)]
+        return FakeSolrResults(page, len(docs), str(start + len(page)))
+
+    def add(self, docs, commit=True, **kwargs):
+        for doc in docs:
+            self.docs[doc['id']] = doc
+        if commit:
+            self.commit()
+
+    def delete(self, id=None, q=None, commit=True, **kwargs):
+        if id:
+            self.docs.pop(id, None)
+        if commit:
+            self.commit()
+
+    def commit(self, **kwargs):
+        self.commits += 1
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('-c', '--config', dest='config',
+                      help='the CKAN configuration file')
+    parser.add_option('--sources', type='int', default=10,
+                      help='number of harvest sources')
+    parser.add_option('--jobs', type='int', default=20,
+                      help='number of finished harvest jobs per source')
+    parser.add_option('--objects', type='int', default=50,
+                      help='number of harvest objects per job')
+    parser.add_option('--keep', type='int', default=2,
+                      help='number of harvest jobs to keep per source')
+    parser.add_option('--resources', type='int', default=1000,
+                      help='number of deleted and of active resources')
+    parser.add_option('--files', type='int', default=1000,
+                      help='number of orphaned files in the filestore')
+    parser.add_option('--extras', type='int', default=1000,
+                      help='number of package extras to clean up')
+    parser.add_option('--packages', type='int', default=1000,
+                      help='number of packages for the index check '
+                           '(at least as many as extras are created)')
+    parser.add_option('--dryrun', action='store_true', default=False,
+                      help='benchmark the dry runs of the cleanups')
+    parser.add_option('--only', action='append', dest='actions',
+                      help='only benchmark this action (repeatable)')
+    parser.add_option('--output', dest='output',
+                      help='append the results as JSON lines to this file')
+    options, args = parser.parse_args()
+    if not options.config:
+        parser.error('please provide a CKAN configuration file with -c')
+
+    _load_ckan(options.config)
+    foreign_rows = count_foreign_rows()
+    if foreign_rows:
+        parser.error(
+            'the database holds data that is not part of the fixtures '
+            'and would be deleted by the cleanups ({}): please run the '
+            'benchmark against an empty test database'.format(', '.join(
+                '{} {}'.format(count, table)
+                for table, count in foreign_rows.items())))
+    results = []
+    for action in options.actions or ACTIONS:
+        results.append(run_benchmark(action, options))
+    _print_results(results)
+    if options.output:
+        with open(options.output, 'a') as output:
+            for result in results:
+                output.write(json.dumps(result) + '\n')
+
+
+def run_benchmark(action, options):
+    """
+    creates fresh fixtures, runs the action in a child process and
+    removes the fixtures again
+    """
+    from ckan import model
+
+    storage = tempfile.mkdtemp(prefix='ogdch-benchmark-')
+    try:
+        fixtures = create_fixtures(storage, options)
+        # the child must not share the connections of this process
+        model.Session.remove()
+        model.meta.engine.dispose()
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_run_action, args=(queue, action, storage, fixtures,
+                                      options))
+        process.start()
+        result = queue.get()
+        process.join()
+    finally:
+        remove_fixtures()
+        shutil.rmtree(storage, ignore_errors=True)
+    result.update({
+        'action': action,
+        'dryrun': options.dryrun,
+        'size': {
+            'sources': options.sources,
+            'jobs': options.jobs,
+            'objects': options.objects,
+            'resources': options.resources,
+            'files': options.files,
+            'extras': options.extras,
+            'packages': options.packages,
+        },
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+    return result
+
+
+def _run_action(queue, action, storage, fixtures, options):
+    from sqlalchemy import event
+    from ckan import model
+
+    statements = [0]
+
+    @event.listens_for(model.meta.engine, 'before_cursor_execute')
+    def count_statement(*args):
+        statements[0] += 1
+
+    _patch_solr(fixtures['indexed_package_ids'])
+    action_func, context, data_dict = _prepare_action(action, storage,
+                                                      options)
+    start = time.time()
+    try:
+        action_func(context, data_dict)
+        error = None
+    except Exception as e:
+        error = repr(e)
+    queue.put({
+        'wall_time': round(time.time() - start, 3),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'sql_statements': statements[0],
+        'error': error,
+    })
+
+
+def _prepare_action(action, storage, options):
+    import ckan.logic
+    from ckan import model
+    import ckanext.ogdchcommands.admin_logic as admin
+    import ckanext.ogdchcommands.logic as logic
+
+    logic.storage_path = storage
+    site_user = ckan.logic.get_action('get_site_user')(
+        {'model': model, 'ignore_auth': True}, {})
+    context = {'model': model,
+               'session': model.Session,
+               'ignore_auth': True,
+               'user': site_user['name']}
+    # the source datasets of the fixtures are not indexed
+    ckan.logic._actions['harvest_source_reindex'] = \
+        lambda context, data_dict: None
+
+    if action == 'cleanup_harvestjobs':
+        return logic.ogdch_cleanup_harvestjobs, context, {
+            'number_of_jobs_to_keep': options.keep,
+            'dryrun': options.dryrun}
+    if action == 'cleanup_resources':
+        return logic.ogdch_cleanup_resources, context, {
+            'dryrun': options.dryrun}
+    if action == 'cleanup_filestore':
+        return logic.ogdch_cleanup_filestore, context, {
+            'dryrun': options.dryrun}
+    if action == 'cleanup_package_extra':
+        return logic.cleanup_package_extra, context, {
+            'key': EXTRA_KEY,
+            'dryrun': options.dryrun}
+    if action == 'check_indexing':
+        return admin.ogdch_check_indexing, context, {}
+    raise ValueError('unknown action {}'.format(action))
+
+
+def _patch_solr(indexed_package_ids):
+    import ckan.lib.search.common
+    import ckan.lib.search.index
+    import ckanext.ogdchcommands.search
+
+    solr = FakeSolr({'id': id, 'index_id': id}
+                    for id in indexed_package_ids)
+    for module in (ckan.lib.search.common, ckan.lib.search.index,
+                   ckanext.ogdchcommands.search):
+        module.make_connection = lambda *args, **kwargs: solr
+
+
+def create_fixtures(storage, options):
+    """
+    creates the synthetic data in the database and the filestore and
+    returns the ids that are needed by the Solr stand-in
+    """
+    import sqlalchemy as sa
+    from ckan import model
+
+    remove_fixtures()
+    session = model.Session
+    params = {'marker': BENCHMARK_MARKER,
+              'sources': options.sources,
+              'jobs': options.jobs,
+              'objects': options.objects,
+              'resources': options.resources,
+              'extras': options.extras,
+              'packages': options.packages,
+              'extra_key': EXTRA_KEY}
+    for sql in FIXTURE_SQL:
+        session.execute(sa.text(sql), params)
+    session.commit()
+
+    # files of the active and of the deleted resources and orphans
+    resource_path = os.path.join(storage, 'resources')
+    for state in ('active', 'deleted'):
+        for id, in session.execute(sa.text(
+                'select id from resource where url = :marker '
+                'and state = :state'),
+                {'marker': BENCHMARK_MARKER, 'state': state}):
+            _touch(os.path.join(resource_path, id[0:3], id[3:6], id[6:]))
+    for i in range(options.files):
+        id = '{:032x}'.format(i * 7919 + 1)
+        _touch(os.path.join(resource_path, id[0:3], id[3:6], id[6:]))
+
+    # a tenth of the packages are missing in the index, and the index
+    # has as many entries of packages that do not exist
+    package_ids = [id for id, in session.execute(sa.text(
+        'select id from package where name like :name order by id'),
+        {'name': BENCHMARK_MARKER + '-%'})]
+    indexed_package_ids = [id for i, id in enumerate(package_ids)
+                           if i % 10]
+    indexed_package_ids.extend(
+        '{}-stale-{}'.format(BENCHMARK_MARKER, i)
+        for i in range(len(package_ids) // 10))
+    session.remove()
+    return {'indexed_package_ids': indexed_package_ids}
+
+
+def count_foreign_rows():
+    """
+    returns the number of rows that are not part of the fixtures per
+    table that is touched by the actions
+    """
+    import sqlalchemy as sa
+    from ckan import model
+
+    counts = {}
+    for table, sql in FOREIGN_ROWS_SQL:
+        count = model.Session.execute(
+            sa.text(sql), {'marker': BENCHMARK_MARKER}).scalar()
+        if count:
+            counts[table] = count
+    model.Session.remove()
+    return counts
+
+
+def remove_fixtures():
+    import sqlalchemy as sa
+    from ckan import model
+
+    for sql in REMOVE_FIXTURE_SQL:
+        model.Session.execute(sa.text(sql), {'marker': BENCHMARK_MARKER})
+    model.Session.commit()
+
+
+def _touch(path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    open(path, 'a').close()
+
+
+FIXTURE_SQL = [
+    # the packages of the index check: each of them has an extra to
+    # clean up, the first one holds the resources
+    '''insert into package (id, name, type, state, private)
+    select md5(:marker || '-package-' || i), :marker || '-' || i,
+        'dataset', 'active', false
+    from generate_series(1, greatest(:packages, :extras, 1)) i''',
+    '''insert into resource (id, package_id, url, state, position)
+    select md5(:marker || '-resource-' || i)::uuid::text,
+        md5(:marker || '-package-1'), :marker,
+        case when i % 2 = 0 then 'deleted' else 'active' end, i
+    from generate_series(1, 2 * :resources) i''',
+    '''insert into package_extra (id, package_id, key, value, state)
+    select md5(:marker || '-extra-' || i), md5(:marker || '-package-' || i),
+        :extra_key, 'value', 'active'
+    from generate_series(1, :extras) i''',
+    '''insert into harvest_source (id, url, title, type, active, created)
+    select md5(:marker || '-source-' || s), :marker || '/' || s,
+        :marker, 'benchmark', true, now()
+    from generate_series(1, :sources) s''',
+    '''insert into harvest_job (id, source_id, status, created)
+    select md5(:marker || '-job-' || s || '-' || j),
+        md5(:marker || '-source-' || s), 'Finished',
+        now() - j * interval '1 day'
+    from generate_series(1, :sources) s, generate_series(1, :jobs) j''',
+    '''insert into harvest_object (id, guid, harvest_job_id,
+        harvest_source_id, current, state)
+    select md5(:marker || '-object-' || s || '-' || j || '-' || o),
+        :marker, md5(:marker || '-job-' || s || '-' || j),
+        md5(:marker || '-source-' || s), false, 'COMPLETE'
+    from generate_series(1, :sources) s, generate_series(1, :jobs) j,
+        generate_series(1, :objects) o''',
+    '''insert into harvest_object_extra (id, harvest_object_id, key, value)
+    select md5(id || '-extra'), id, 'status', 'change'
+    from harvest_object where guid = :marker''',
+    '''insert into harvest_object_error (id, harvest_object_id, message,
+        stage, created)
+    select md5(id || '-error'), id, :marker, 'Import', now()
+    from harvest_object where guid = :marker''',
+]
+
+FOREIGN_ROWS_SQL = [
+    ('harvest_source', '''select count(*) from harvest_source
+        where title is distinct from :marker'''),
+    ('harvest_job', '''select count(*) from harvest_job j
+        where not exists (select 1 from harvest_source s
+            where s.id = j.source_id and s.title = :marker)'''),
+    ('harvest_object', '''select count(*) from harvest_object
+        where guid is distinct from :marker'''),
+    ('package', "select count(*) from package where name not like "
+                ":marker || '-%'"),
+    ('resource', '''select count(*) from resource
+        where url is distinct from :marker'''),
+    ('package_extra', '''select count(*) from package_extra e
+        where not exists (select 1 from package p
+            where p.id = e.package_id and p.name like :marker || '-%')'''),
+]
+
+REMOVE_FIXTURE_SQL = [
+    '''delete from harvest_object_error where harvest_object_id in (
+        select id from harvest_object where guid = :marker)''',
+    '''delete from harvest_object_extra where harvest_object_id in (
+        select id from harvest_object where guid = :marker)''',
+    'delete from harvest_object where guid = :marker',
+    '''delete from harvest_job where source_id in (
+        select id from harvest_source where title = :marker)''',
+    'delete from harvest_source where title = :marker',
+    '''delete from package_extra where package_id in (
+        select id from package where name like :marker || '-%')''',
+    '''delete from resource where package_id in (
+        select id from package where name like :marker || '-%')''',
+    "delete from package where name like :marker || '-%'",
+]
+
+
+def _load_ckan(config_path):
+    from ckan.lib.cli import load_config
+    load_config(os.path.abspath(config_path))
+
+
+def _print_results(results):
+    row_format = '{:<24}{:>12}{:>16}{:>16}  {}'
+    print(row_format.format('action', 'wall time s', 'peak RSS kB',
+                            'SQL statements', 'error'))
+    for result in results:
+        print(row_format.format(result['action'], result['wall_time'],
+                                result['peak_rss_kb'],
+                                result['sql_statements'],
+                                result['error'] or ''))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,3 +10,6 @@ trap "cleanup" EXIT
 
 # Check PEP-8 code style and McCabe complexity
 flake8 --statistics --show-source ckanext
+
+# Run the unit tests
+nosetests ckanext/ogdchcommands/tests
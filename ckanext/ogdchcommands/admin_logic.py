@@ -4,62 +4,170 @@ import logging
 import json
 import traceback
 from ckan import authz
-from ckan.lib.search import rebuild as rebuild_search_index
-from ckan.lib.search import query_for
+from ckan.common import config
 from ckan.plugins.toolkit import side_effect_free, get_or_bust
 import ckan.model as model
 import ckan.plugins.toolkit as tk
 from ckan.logic import NotFound
+from ckanext.ogdchcommands import jobs, metrics
+from ckanext.ogdchcommands.cache import TTLCache
+from ckanext.ogdchcommands.reindex import (
+    get_package_ids, reindex_packages, remove_stale_entries,
+    REINDEX_BATCH_SIZE)
+from ckanext.ogdchcommands.search import (
+    iter_index_differences, iter_solr_docs, site_filter)
 
 log = logging.getLogger(__name__)
 
+# names of users and packages of the latest activities
+_user_cache = TTLCache(maxsize=1000, ttl=300)
+_package_cache = TTLCache(maxsize=1000, ttl=300)
+
 
 @side_effect_free
+@metrics.instrument('ogdch_reindex')
 def ogdch_reindex(context, data_dict):
+    """
+    reindexes the packages `batch_size` packages at a time: the index is
+    committed once at the end. A full reindex then removes the index
+    entries of deleted packages. With `background=true` the work is done
+    by a background job and its id is returned right away, only such a
+    job indexes with a pool of `workers` processes.
+    """
     current_user = context.get('user')
     if not authz.is_sysadmin(current_user):
         return "not authorized"
-    package_id = data_dict.get('id')
-    only_missing = data_dict.get('only_missing')
+    if tk.asbool(data_dict.get('background', False)):
+        return _enqueue(_reindex, data_dict, 'ogdch_reindex')
 
     try:
-        rebuild_search_index(package_id=package_id, only_missing=only_missing)
+        with metrics.phase(context, 'reindex'):
+            result = _reindex(data_dict)
     except Exception as e:
         return {
             'msg': "an error occured",
             'error': str(e),
             'traceback': traceback.format_exc()
         }
-    return "Success: search index was rebuilt"
+    metrics.count(context, 'packages_indexed', result['indexed'])
+    metrics.count(context, 'packages_failed', result['count_failed'])
+    metrics.count(context, 'index_entries_removed',
+                  result.get('count_removed', 0))
+    result['msg'] = "Success: search index was rebuilt"
+    return result
+
+
+def _reindex(data_dict, progress=None):
+    package_id = data_dict.get('id')
+    only_missing = tk.asbool(data_dict.get('only_missing', False))
+    workers = int(data_dict.get(
+        'workers', config.get('ckanext.ogdchcommands.reindex_workers', 1)))
+    # only a job of the job queue runs in a process of its own: a web
+    # worker must not fork, its connection pool and its scoped session
+    # are shared with the other requests
+    if workers > 1 and (progress is None or jobs.in_process()):
+        log.info('ogdch_reindex is not run by a job of the job queue: '
+                 'the packages are indexed without worker processes')
+        workers = 1
+    batch_size = int(data_dict.get('batch_size', REINDEX_BATCH_SIZE))
+    package_ids = get_package_ids(package_id, only_missing)
+    result = reindex_packages(package_ids, workers, batch_size, progress)
+    # a full reindex also removes the entries of deleted packages
+    if not package_id and not only_missing:
+        result['count_removed'] = remove_stale_entries(batch_size)
+    return result
 
 
 @side_effect_free
+@metrics.instrument('ogdch_check_indexing')
 def ogdch_check_indexing(context, data_dict):
+    """
+    compares the active packages in the database with the packages in
+    the search index: both are streamed in the same order and merged,
+    the ids of the differences are only reported with `with_ids=true`.
+    With `background=true` the work is done by a background job and its
+    id is returned right away.
+    """
     current_user = context.get('user')
     if not authz.is_sysadmin(current_user):
         return "not authorized"
+    if tk.asbool(data_dict.get('background', False)):
+        return _enqueue(_check_indexing, data_dict, 'ogdch_check_indexing')
 
     try:
-        package_query = query_for(model.Package)
-
-        log.debug("Checking packages search index...")
-        pkgs_q = model.Session.query(model.Package).filter_by(
-            state=model.State.ACTIVE)
-        pkgs = set([pkg.id for pkg in pkgs_q])
-        indexed_pkgs = \
-            set(package_query.get_all_entity_ids(max_results=len(pkgs)))
-        pkgs_not_indexed = pkgs - indexed_pkgs
-        return ("there are {} packages not indexed"
-                .format(len(pkgs_not_indexed)))
+        with metrics.phase(context, 'select'):
+            result = _check_indexing(data_dict)
     except Exception as e:
         return {
             'msg': "an error occured",
             'error': str(e),
             'traceback': traceback.format_exc()
         }
+    metrics.gauge(context, 'packages_not_indexed',
+                  result['count_not_indexed'])
+    metrics.gauge(context, 'index_entries_not_in_db',
+                  result['count_not_in_db'])
+    return result
+
+
+def _check_indexing(data_dict, progress=None):
+    with_ids = tk.asbool(data_dict.get('with_ids', False))
+    log.debug("Checking packages search index...")
+    pkgs_not_indexed = []
+    pkgs_not_in_db = []
+    count_not_indexed = 0
+    count_not_in_db = 0
+    for db_id, index_id in iter_index_differences(progress=progress):
+        if db_id:
+            count_not_indexed += 1
+            if with_ids:
+                pkgs_not_indexed.append(db_id)
+        else:
+            count_not_in_db += 1
+            if with_ids:
+                pkgs_not_in_db.append(index_id)
+    result = {
+        'msg': "there are {} packages not indexed and {} index entries "
+               "without a package".format(count_not_indexed,
+                                          count_not_in_db),
+        'count_not_indexed': count_not_indexed,
+        'count_not_in_db': count_not_in_db,
+    }
+    if with_ids:
+        result['not_indexed'] = pkgs_not_indexed
+        result['not_in_db'] = pkgs_not_in_db
+    return result
+
+
+def _enqueue(func, data_dict, title):
+    job_id = jobs.enqueue(func, dict(data_dict), title)
+    return {
+        'msg': "the job has been enqueued, its status is shown by "
+               "ogdch_job_status with id={}".format(job_id),
+        'job_id': job_id,
+    }
+
+
+@side_effect_free
+@metrics.instrument('ogdch_job_status')
+def ogdch_job_status(context, data_dict):
+    """
+    shows the status of a background job of ogdch_reindex or
+    ogdch_check_indexing: its progress, its throughput and its result
+    once it is finished
+    """
+    current_user = context.get('user')
+    if not authz.is_sysadmin(current_user):
+        return "not authorized"
+    job_id = get_or_bust(data_dict, 'id')
+    status = jobs.get_status_store().get(job_id)
+    if status is None:
+        raise NotFound('Job {} does not exist'.format(job_id))
+    return status
 
 
 @side_effect_free
+@metrics.instrument('ogdch_check_field')
 def ogdch_check_field(context, data_dict):
     current_user = context.get('user')
     if not authz.is_sysadmin(current_user):
@@ -69,7 +177,8 @@ def ogdch_check_field(context, data_dict):
         return "please provide a field name with field="
 
     results = []
-    for package in _search_for_datasets(context):
+    for package in metrics.timed(context, 'select',
+                                 _search_for_datasets(field)):
         field_data_raw = package.get(field)
         field_data = ''
         if field_data_raw:
@@ -92,39 +201,28 @@ def ogdch_check_field(context, data_dict):
     }
 
 
-def _search_for_datasets(context):
-    rows = 500
-    page = 0
-    result_count = 0
-    fq = "dataset_type:(dataset)"
-    processed_count = 0
-    while page == 0 or processed_count < result_count:
-        try:
-            page = page + 1
-            start = (page - 1) * rows
-            data_dict = {
-                'fq': fq,
-                'rows': rows,
-                'start': start,
-                'include_private': True
-            }
-            result = tk.get_action('package_search')(context, data_dict)
-            print("{} datasets have been found".format(result['count']))
-            if not result_count:
-                result_count = result['count']
-            datasets_in_result = result.get('results')
-            if datasets_in_result:
-                for dataset in datasets_in_result:
-                    yield dataset
-            processed_count += len(datasets_in_result)
-        except Exception as e:
-            print("Error occured while searching for "
-                  "packages with fq: {}, error: {}"
-                  .format(fq, e))
-            break
+def _search_for_datasets(field):
+    """
+    yields the name and the value of a field for all datasets: the index
+    is paged with a cursor and only the name and the stored package dict
+    are fetched, no search plugins are run on the results
+    """
+    fq = ['+dataset_type:dataset', '+state:active', site_filter()]
+    count = 0
+    try:
+        for doc in iter_solr_docs(fq=fq, fl='name,validated_data_dict'):
+            count += 1
+            package = json.loads(doc['validated_data_dict'])
+            yield {'name': doc['name'], field: package.get(field)}
+    except Exception as e:
+        print("Error occured while searching for "
+              "packages with fq: {}, error: {}"
+              .format(fq, e))
+    print("{} datasets have been found".format(count))
 
 
 @side_effect_free
+@metrics.instrument('ogdch_latest_dataset_activities')
 def ogdch_latest_dataset_activities(context, data_dict):
     '''
     Show recent activities for datasets
@@ -132,13 +230,21 @@ def ogdch_latest_dataset_activities(context, data_dict):
     user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
     context.update({'user': user['name']})
 
-    result = tk.get_action('recently_changed_packages_activity_list')(
-        context,
-        data_dict,
-    )
+    with metrics.phase(context, 'select'):
+        result = tk.get_action('recently_changed_packages_activity_list')(
+            context,
+            data_dict,
+        )
+        package_items = [item for item in result
+                         if _activity_relates_to_a_package(item)]
+        users = _get_user_names(
+            set(item.get('user_id') for item in package_items))
+        packages = _get_packages(
+            set(item.get('object_id') for item in package_items))
+
     activities = []
-    for item in result:
-        mapped_activity = _check_and_map_activity_item(item)
+    for item in package_items:
+        mapped_activity = _check_and_map_activity_item(item, users, packages)
         if mapped_activity:
             activities.append(mapped_activity)
     if activities:
@@ -147,30 +253,62 @@ def ogdch_latest_dataset_activities(context, data_dict):
         raise NotFound
 
 
-def _check_and_map_activity_item(item):
+def _activity_relates_to_a_package(item):
     activity_type = item.get('activity_type')
+    return activity_type and 'package' in activity_type
+
+
+def _get_user_names(user_ids):
+    """
+    returns the names of the users by id: users that are not cached
+    are loaded with one query
+    """
+    names = _user_cache.get_many(user_ids)
+    missing_ids = [id for id in user_ids if id and id not in names]
+    if missing_ids:
+        loaded = dict(model.Session.query(model.User.id, model.User.name)
+                      .filter(model.User.id.in_(missing_ids)))
+        _user_cache.set_many(loaded)
+        names.update(loaded)
+    return names
+
+
+def _get_packages(package_ids):
+    """
+    returns name, type and visibility of the packages by id: packages
+    that are not cached are loaded with one query
+    """
+    packages = _package_cache.get_many(package_ids)
+    missing_ids = [id for id in package_ids if id and id not in packages]
+    if missing_ids:
+        loaded = {}
+        for id, name, package_type, private, state in model.Session.query(
+                model.Package.id, model.Package.name, model.Package.type,
+                model.Package.private, model.Package.state) \
+                .filter(model.Package.id.in_(missing_ids)):
+            loaded[id] = {'name': name,
+                          'type': package_type,
+                          'visible': state == 'active' and not private}
+        _package_cache.set_many(loaded)
+        packages.update(loaded)
+    return packages
+
+
+def _check_and_map_activity_item(item, users, packages):
     user_id = item.get('user_id')
     object_id = item.get('object_id')
     data = item.get('data')
-    activity_relates_to_a_package = \
-        activity_type and 'package' in activity_type
-    if not activity_relates_to_a_package:
-        return False
     activity = {}
-    try:
-        user = tk.get_action('user_show')({}, {'id': user_id})
-        activity['user'] = user.get('name')
-    except NotFound:
-        activity['user'] = user_id
-    try:
-        package = tk.get_action('package_show')({},
-                                                {'id': object_id})
-        if package.get('type') != 'dataset':
+    activity['user'] = users.get(user_id, user_id)
+    package = packages.get(object_id)
+    if package:
+        # package_show without a user does not show these packages
+        if not package['visible'] or package['type'] != 'dataset':
             return False
         if data and data.get('message'):
             activity['message'] = data['message']
-        activity['package'] = package.get('name')
-    except NotFound:
+        activity['package'] = package['name']
+    else:
         activity['package'] = object_id
     activity['time'] = item.get('timestamp')
     return activity
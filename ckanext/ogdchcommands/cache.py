@@ -0,0 +1,49 @@
+# encoding: utf-8
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    a small least recently used cache whose entries expire after `ttl`
+    seconds: it is shared by the requests of a process
+    """
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        """
+        returns the cached values for the keys that are cached and
+        not expired
+        """
+        now = time.time()
+        values = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is None:
+                    continue
+                expires, value = entry
+                if expires > now:
+                    self._entries[key] = entry
+                    values[key] = value
+        return values
+
+    def set_many(self, values):
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key, value in values.items():
+                self._entries.pop(key, None)
+                self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,10 +1,23 @@
+import json
 import sys
-import itertools
-import traceback
+from datetime import date, datetime
 import ckan.lib.cli
 import ckan.logic as logic
 import ckan.model as model
-from datetime import datetime
+from ckanext.ogdchcommands.db import batches
+from ckanext.ogdchcommands.metrics import Metrics
+from ckanext.ogdchcommands.plan import PLAN_KEY, Plan
+from ckanext.ogdchcommands.report import REPORT_KEY, open_report
+from ckanext.ogdchcommands.search import (
+    deferred_commits, iter_solr_docs, site_filter)
+
+PUBLISH_BATCH_SIZE = 100
+SCHEDULED_FORMATS = ['%d.%m.%Y', '%Y-%m-%d']
+
+# the commands that can write a deletion plan with --plan
+PLAN_COMMANDS = ['cleanup_harvestjobs', 'cleanup_resources',
+                 'cleanup_extras', 'cleanup_filestore',
+                 'cleanup_harvestobjects']
 
 
 msg_resource_cleanup_dryrun = """Resources cleanup:
@@ -22,13 +35,29 @@ There are {1} filestore-entries associated with those resources that can be dele
 {2}
 """
 
-msg_package_extra_cleanup_dryrun = """\npackage extra cleanup for key '{1}':\n\n
-There are {0} package extras with key '{1}'.
+msg_package_extra_cleanup_dryrun = """\npackage extra cleanup for keys {1}:\n\n
+There are {0} package extras with these keys:
+{2}
 If you want to delete them, run this command
 again without the option --dryrun!\n"""
 
-msg_package_extra_cleanup = """\npackage extra cleanup for key '{1}':\n\n
-{0} package extras with key '{1}' have been deleted.\n"""
+msg_package_extra_cleanup = """\npackage extra cleanup for keys {1}:\n\n
+{0} package extras with these keys have been deleted:
+{2}
+"""
+
+msg_harvestobject_cleanup_dryrun = """Orphaned harvest objects cleanup:
+================================
+There are {0} orphaned rows that can be deleted:
+{1}
+If you want to delete them, run this command
+again without the option --dryrun!"""
+
+msg_harvestobject_cleanup = """Orphaned harvest objects cleanup:
+================================
+{0} orphaned rows have been deleted:
+{1}
+"""
 
 msg_filestore_cleanup_dryrun = """Filestore cleanup:
 ==================
@@ -48,6 +77,30 @@ Following errors occured, please check those cases manually:
 """
 
 
+def parse_scheduled(scheduled):
+    """
+    returns the scheduled date of a dataset, formatted as in the dataset
+    or as a Solr date, or None if it cannot be read
+    """
+    if not scheduled:
+        return None
+    for scheduled_format in SCHEDULED_FORMATS:
+        try:
+            return datetime.strptime(
+                scheduled[:10], scheduled_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def is_due_to_be_published(scheduled, today):
+    """
+    checks whether the scheduled date of a dataset is today or earlier
+    """
+    scheduled_date = parse_scheduled(scheduled)
+    return scheduled_date is not None and scheduled_date <= today
+
+
 class OgdchCommands(ckan.lib.cli.CkanCommand):
     '''Commands for opendata.swiss
     Usage:
@@ -58,32 +111,61 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
         paster ogdch help
 
         # Cleanup datastore
-        paster ogdch cleanup_datastore
+        paster ogdch cleanup_datastore [--dryrun]
+        # - drops the datastore tables of resources that are not active
+        # - the command can be performed with a dryrun option where the
+        #   datastore will remain unchanged
 
         # Cleanup resources
-        paster ogdch cleanup_resources [--dryrun]
+        paster ogdch cleanup_resources [--dryrun] [--workers={n}]
         # - delete resources that have the state 'deleted'
         # - also cleans their dependencies in resource_view and resource_revision
         # - the command can be performed with a dryrun option where the
         #   database will remain unchanged
 
         # Cleanup filestore
-        paster ogdch cleanup_filestore [--dryrun]
+        paster ogdch cleanup_filestore [--dryrun] [--workers={n}]
+            [--incremental] [--full]
         # - delete filestore files that are no longer associated with a resource.
+        # - the filestore is scanned and cleaned by n parallel workers
+        #   (default 1)
+        # - with --incremental only directories that changed since the last
+        #   run are scanned, --full rescans everything and rebuilds the
+        #   manifest of the incremental runs
         # - the command can be performed with a dryrun option where the
         #   filestore will remain unchanged
 
         # Cleanup package_extras
-        paster ogdch cleanup_extras {key}  [--dryrun]
-        # - delete package extras for a key
+        paster ogdch cleanup_extras [{key} ...] [--key_pattern={pattern}]
+            [--dryrun]
+        # - delete package extras for one or more keys and/or for the keys
+        #   that match a SQL LIKE pattern, e.g. 'legacy_%'
+        # - all keys are counted with one query and deleted in one pass
 
         # Cleanup harvester jobs and objects:
         # - deletes all the harvest jobs and objects except the latest n
         # - the default number of jobs to keep is 10
         # - the command can be performed with a dryrun option where the
         #   database will remain unchanged
+        # - the jobs are deleted in chunks that are committed one by one
+        #   and recorded in a journal: with --resume an interrupted run
+        #   continues where it stopped
+        # - with --time_budget the run stops after n seconds, it can be
+        #   continued with --resume
+        # - the sources are cleaned up by n parallel workers (default 1)
+        # - the cleaned sources are reindexed together at the end, with
+        #   --enqueue_reindex by a background job
         paster ogdch cleanup_harvestjobs
-            [{source_id}] [--keep={n}] [--dryrun]
+            [{source_id}] [--keep={n}] [--dryrun] [--resume]
+            [--time_budget={seconds}] [--workers={n}] [--enqueue_reindex]
+
+        # Cleanup orphaned harvest objects:
+        # - deletes the harvest objects whose job or package no longer
+        #   exists and the harvest object extras and errors whose object
+        #   no longer exists or is orphaned
+        # - the orphans are deleted in batches, the dryrun option counts
+        #   them per table
+        paster ogdch cleanup_harvestobjects [--dryrun]
 
         # Publish scheduled datasets
         # checks for private datasets that have a scheduled date
@@ -99,6 +181,30 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
         paster ogdch clear_stale_harvestsources
         [--keep_harvestsource_days={n}]
 
+        # Throttling
+        # - cleanup_harvestjobs, cleanup_harvestobjects, cleanup_resources
+        #   and cleanup_filestore accept --rows_per_second={n},
+        #   --files_per_second={n} and --latency_threshold_ms={n}: the
+        #   rows are deleted in small chunks at the given pace and the
+        #   cleanup backs off while statements are slower than the
+        #   threshold
+        # - the defaults are set in the config with
+        #   ckanext.ogdchcommands.throttle.*
+
+        # Reports
+        # - all commands accept --report=ndjson[:path]: one JSON record per
+        #   deleted or published item is streamed to stdout or to the file
+        #   while the command runs, followed by a summary record
+
+        # Deletion plans
+        # - cleanup_harvestjobs, cleanup_harvestobjects, cleanup_resources,
+        #   cleanup_extras and cleanup_filestore accept --plan={path}:
+        #   nothing is deleted, the ids and files to delete are written
+        #   to a checksummed plan
+        # - apply_plan deletes exactly what is in the plan, without
+        #   looking for anything to delete again
+        paster ogdch apply_plan {path} [--workers={n}] [--enqueue_reindex]
+
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -112,9 +218,75 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
         self.parser.add_option(
             '--dryrun', action="store_true", dest='dryrun',
             default=False,
-            help='dryrun of cleanup harvestjobs and '
+            help='dryrun of cleanup harvestjobs and cleanup_datastore and '
+                 'cleanup_harvestobjects and '
                  'publish_scheduled_datasets and cleanup_resources '
                  'and cleanup_extras and cleanup_filestore')
+        self.parser.add_option(
+            '--workers', action="store", type="int", dest='workers',
+            default=1,
+            help='The number of parallel workers that scan and delete '
+                 'files in cleanup_filestore and cleanup_resources and '
+                 'that clean up the sources in cleanup_harvestjobs')
+        self.parser.add_option(
+            '--incremental', action="store_true", dest='incremental',
+            default=False,
+            help='cleanup_filestore only scans the directories that have '
+                 'changed since the last incremental run')
+        self.parser.add_option(
+            '--full', action="store_true", dest='full',
+            default=False,
+            help='cleanup_filestore scans all directories and rebuilds '
+                 'the manifest of the incremental runs')
+        self.parser.add_option(
+            '--resume', action="store_true", dest='resume',
+            default=False,
+            help='cleanup_harvestjobs continues the run that was '
+                 'interrupted or stopped by its time budget')
+        self.parser.add_option(
+            '--time_budget', action="store", type="int", dest='time_budget',
+            default=None,
+            help='The number of seconds after which cleanup_harvestjobs '
+                 'stops: the run can be continued with --resume')
+        self.parser.add_option(
+            '--enqueue_reindex', action="store_true", dest='enqueue_reindex',
+            default=False,
+            help='cleanup_harvestjobs enqueues the reindexing of the '
+                 'cleaned sources as a background job')
+        self.parser.add_option(
+            '--key_pattern', action="store", type="string",
+            dest='key_pattern', default=None,
+            help='cleanup_extras also deletes the extras whose key matches '
+                 'this SQL LIKE pattern')
+        self.parser.add_option(
+            '--rows_per_second', action="store", type="float",
+            dest='rows_per_second', default=None,
+            help='The maximum number of rows that cleanup_harvestjobs, '
+                 'cleanup_harvestobjects and cleanup_resources delete '
+                 'per second')
+        self.parser.add_option(
+            '--files_per_second', action="store", type="float",
+            dest='files_per_second', default=None,
+            help='The maximum number of files that cleanup_resources and '
+                 'cleanup_filestore remove per second')
+        self.parser.add_option(
+            '--latency_threshold_ms', action="store", type="float",
+            dest='latency_threshold_ms', default=None,
+            help='The cleanups back off while delete statements take '
+                 'longer than this number of milliseconds')
+        self.parser.add_option(
+            '--report', action="store", type="string", dest='report',
+            default=None,
+            help='Streams a record per item and a summary as ndjson to '
+                 'stdout (--report=ndjson) or to a file '
+                 '(--report=ndjson:path) instead of printing the result')
+        self.parser.add_option(
+            '--plan', action="store", type="string", dest='plan',
+            default=None,
+            help='cleanup_harvestjobs, cleanup_harvestobjects, '
+                 'cleanup_resources, cleanup_extras and cleanup_filestore '
+                 'write what they would delete to this plan file instead '
+                 'of deleting it')
         self.parser.add_option(
             '--keep_harvestsource_days', action="store", type="int",
             dest='timeframe_to_keep_harvested_datasets',
@@ -129,23 +301,89 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
             'cleanup_datastore': self.cleanup_datastore,
             'help': self.help,
             'cleanup_harvestjobs': self.cleanup_harvestjobs,
+            'cleanup_harvestobjects': self.cleanup_harvestobjects,
             'publish_scheduled_datasets': self.publish_scheduled_datasets,
             'cleanup_resources': self.cleanup_resources,
             'cleanup_filestore': self.cleanup_filestore,
             'cleanup_extras': self.cleanup_extras,
             'clear_stale_harvestsources': self.clear_stale_harvestsources,
+            'apply_plan': self.apply_plan,
         }
 
         try:
             cmd = self.args[0]
-            options[cmd](*self.args[1:])
+            command = options[cmd]
         except (KeyError, IndexError):
             self.help()
             sys.exit(1)
 
+        self.report = None
+        if self.options.report:
+            try:
+                self.report = open_report(self.options.report)
+            except (ValueError, IOError) as e:
+                print(e)
+                sys.exit(1)
+
+        # a plan is written by a dry run of the command
+        self.plan = None
+        if self.options.plan:
+            if cmd not in PLAN_COMMANDS:
+                print('{} cannot write a plan'.format(cmd))
+                sys.exit(1)
+            self.plan = Plan(cmd)
+            self.options.dryrun = True
+
+        # the actions that are called export their own metrics
+        self.metrics = Metrics('ogdch_cmd_' + cmd)
+        success = False
+        try:
+            command(*self.args[1:])
+            if self.plan:
+                self._save_plan()
+            success = True
+        finally:
+            self.metrics.export(success)
+            if self.report:
+                self.report.close()
+
     def help(self):
         print(self.__doc__)
 
+    def _throttle_options(self):
+        """
+        the throttle options of the command line: the actions fall back
+        to the config for the options that are not set
+        """
+        return {
+            'rows_per_second': self.options.rows_per_second,
+            'files_per_second': self.options.files_per_second,
+            'latency_threshold_ms': self.options.latency_threshold_ms,
+        }
+
+    def _add_report(self, context):
+        """
+        passes the report and the plan to the actions that are called with
+        the context
+        """
+        if self.report:
+            context[REPORT_KEY] = self.report
+        if self.plan:
+            context[PLAN_KEY] = self.plan
+        return context
+
+    def _save_plan(self):
+        self.plan.save(self.options.plan)
+        counts = self.plan.counts()
+        if self.report:
+            self.report.record('plan', path=self.options.plan, **counts)
+            return
+        print('\nThe plan has been written to {}:'.format(self.options.plan))
+        for name, count in counts.items():
+            print('- {}: {}'.format(name, count))
+        print('Apply it with: paster ogdch apply_plan {}'
+              .format(self.options.plan))
+
     def publish_scheduled_datasets(self):
         """
         command to publish scheduled datasets
@@ -163,33 +401,38 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
             print("User is not authorized to perform this action.")
             sys.exit(1)
 
-        query = logic.get_action('package_search')(
-            context,
-            {
-                'q': '*:*',
-                'fq': '+capacity:private +scheduled:[* TO *]',
-                'include_private': True,
-             }
-        )
-        private_datasets = query['results']
-        log_output = """Private datasets that are due to be published: \n\n"""
-        for dataset in private_datasets:
-            data_dict = self._is_dataset_due_to_be_published(context, dataset)
-            if data_dict:
-                log_output += 'Private dataset: "%s" (%s) ... ' % (
-                    data_dict.get('name'),
-                    data_dict.get('scheduled')
-                )
-                if not self.options.dryrun:
-                    data_dict['private'] = False
-                    logic.get_action('package_patch')(context, data_dict)
-                    log_output += "has been published.\n"
-                else:
-                    log_output += "is due to be published.\n"
-
-        print(log_output)
-
-        if self.options.dryrun:
+        # the index only pre-filters the datasets: the range is in UTC
+        # and compares text if scheduled is not indexed as a date, so
+        # the scheduled date of every dataset is checked as well. The
+        # field is not stored in the index, it is read from the stored
+        # package dict.
+        fq = ['+capacity:private',
+              '+state:active',
+              '+scheduled:[* TO NOW/DAY+2DAYS}',
+              site_filter()]
+        due_datasets = self._get_due_datasets(self.metrics.timed(
+            'select',
+            iter_solr_docs(fq=fq, fl='id,name,validated_data_dict')))
+
+        # every dataset is printed or reported as soon as it is done
+        if not self.report:
+            print("""Private datasets that are due to be published: \n""")
+        count = 0
+        for batch in batches(due_datasets, PUBLISH_BATCH_SIZE):
+            with self.metrics.phase('publish'), deferred_commits():
+                for doc in batch:
+                    count += 1
+                    if not self.options.dryrun:
+                        logic.get_action('package_patch')(
+                            context, {'id': doc['id'], 'private': False})
+                        self.metrics.count('datasets_published')
+                    self._print_scheduled_dataset(doc)
+
+        if self.report:
+            self.report.summary(command='publish_scheduled_datasets',
+                                dryrun=self.options.dryrun,
+                                count_published=count)
+        elif self.options.dryrun:
             print('\nThis has been a dry run: '
                   'if you want to perfom these changes'
                   ' run this again without the option --dryrun!')
@@ -197,18 +440,42 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
             print('\nPrivate datasets that are due have been published. '
                   'See output above about what has been done.')
 
-    @staticmethod
-    def _is_dataset_due_to_be_published(context, dataset):
-        issued_datetime = datetime.strptime(
-            dataset.get('scheduled'),
-            '%d.%m.%Y'
-        )
-        if issued_datetime.date() <= datetime.today().date():
-            return logic.get_action('package_show')(context, {
-                'id': dataset.get('id')
-            })
-        else:
-            return None
+    def _get_due_datasets(self, docs):
+        """
+        yields the datasets that are due to be published: a dataset whose
+        scheduled date cannot be read is never skipped silently
+        """
+        today = date.today()
+        for doc in docs:
+            scheduled = json.loads(doc['validated_data_dict']).get(
+                'scheduled')
+            if parse_scheduled(scheduled) is None:
+                error = 'The scheduled date {!r} cannot be read'.format(
+                    scheduled)
+                self.metrics.count('errors')
+                if self.report:
+                    self.report.record('error', id=doc['id'],
+                                       name=doc['name'], exception=error)
+                else:
+                    print('Private dataset: "%s" ... %s' % (
+                        doc['name'], error))
+                continue
+            if is_due_to_be_published(scheduled, today):
+                yield {'id': doc['id'], 'name': doc['name'],
+                       'scheduled': scheduled}
+
+    def _print_scheduled_dataset(self, doc):
+        if self.report:
+            self.report.record('dataset', id=doc['id'], name=doc['name'],
+                               scheduled=doc.get('scheduled'),
+                               published=not self.options.dryrun)
+            return
+        print('Private dataset: "%s" (%s) ... %s' % (
+            doc['name'],
+            doc.get('scheduled'),
+            "is due to be published." if self.options.dryrun
+            else "has been published."
+        ))
 
     def cleanup_datastore(self):
         user = logic.get_action('get_site_user')({'ignore_auth': True}, {})
@@ -224,73 +491,33 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
             print("User is not authorized to perform this action.")
             sys.exit(1)
 
-        # query datastore to get all resources from the _table_metadata
-        resource_id_list = []
-        try:
-            for offset in itertools.count(start=0, step=100):
-                print(
-                    "Load metadata records from datastore (offset: %s)"
-                    % offset
-                )
-                record_list, has_next_page = self._get_datastore_table_page(context, offset)  # noqa
-                resource_id_list.extend(record_list)
-                if not has_next_page:
-                    break
-        except Exception as e:
-            print(
-                "Error while gathering resources: %s / %s"
-                % (str(e), traceback.format_exc())
-            )
-
-        # delete the rows of the orphaned datastore tables
-        delete_count = 0
-        for resource_id in resource_id_list:
-            logic.check_access('datastore_delete', context)
-            logic.get_action('datastore_delete')(
-                context,
-                {'resource_id': resource_id, 'force': True}
-            )
-            print("Table '%s' deleted (not dropped)" % resource_id)
-            delete_count += 1
-
-        print("Deleted content of %s tables" % delete_count)
-
-    def _get_datastore_table_page(self, context, offset=0):
-        # query datastore to get all resources from the _table_metadata
-        result = logic.get_action('datastore_search')(
-            context,
+        # check the datastore tables page by page against the resources
+        result = logic.get_action('ogdch_cleanup_datastore')(
+            self._add_report(context),
             {
-                'resource_id': '_table_metadata',
-                'offset': offset
-            }
-        )
-
-        resource_id_list = []
-        for record in result['records']:
-            try:
-                # ignore 'alias' records
-                if record['alias_of']:
-                    continue
-
-                logic.check_access('resource_show', context)
-                logic.get_action('resource_show')(
-                    context,
-                    {'id': record['name']}
-                )
-                print("Resource '%s' found" % record['name'])
-            except logic.NotFound:
-                resource_id_list.append(record['name'])
-                print("Resource '%s' *not* found" % record['name'])
-            except logic.NotAuthorized:
-                print("User is not authorized to perform this action.")
-            except (KeyError, AttributeError) as e:
-                print("Error while handling record %s: %s" % (record, str(e)))
-                continue
-
-        # are there more records?
-        has_next_page = (len(result['records']) > 0)
+                'dryrun': self.options.dryrun,
+            })
+        if self.report:
+            self._report_summary('cleanup_datastore',
+                                 count_tables=result['count_tables'],
+                                 count_deleted=result['count_deleted'])
+            return
+        for resource_id in result['tables']:
+            if self.options.dryrun:
+                print("Resource '%s' *not* found" % resource_id)
+            else:
+                print("Table '%s' dropped" % resource_id)
 
-        return (resource_id_list, has_next_page)
+        print("Checked %s datastore tables" % result['count_tables'])
+        if self.options.dryrun:
+            print("%s tables can be deleted. If you want to delete them, "
+                  "run this command again without the option --dryrun!"
+                  % result['count_deleted'])
+        else:
+            print("Dropped %s tables" % result['count_deleted'])
+            for error in result['errors']:
+                print("Table '%s' could not be dropped: %s"
+                      % (error['name'], error['exception']))
 
     def cleanup_filestore(self, source=None):
         """
@@ -304,11 +531,17 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
             'user': user['name']
         }
         result = logic.get_action('ogdch_cleanup_filestore')(
-            context,
-            {
+            self._add_report(context),
+            dict({
                 'dryrun': self.options.dryrun,
-            })
-        if self.options.dryrun:
+                'workers': self.options.workers,
+                'incremental': self.options.incremental,
+                'full': self.options.full,
+            }, **self._throttle_options()))
+        if self.report:
+            self._report_summary('cleanup_filestore',
+                                 file_count=result.get('file_count'))
+        elif self.options.dryrun:
             print(msg_filestore_cleanup_dryrun
                   .format(result.get('file_count'), result.get('filepaths'), result.get('errors')))
         else:
@@ -333,26 +566,35 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
             print("User is not authorized to perform this action.")
             sys.exit(1)
         result = logic.get_action('ogdch_cleanup_resources')(
-            context,
-            {
+            self._add_report(context),
+            dict({
                 'dryrun': self.options.dryrun,
-            })
-        if self.options.dryrun:
+                'workers': self.options.workers,
+            }, **self._throttle_options()))
+        if self.report:
+            self._report_summary(
+                'cleanup_resources',
+                count_deleted=result.get('count_deleted'),
+                count_filestores=result.get('count_filestores'),
+                deleted_rows=result.get('deleted_rows'))
+        elif self.options.dryrun:
             print(msg_resource_cleanup_dryrun
                   .format(result.get('count_deleted'), result.get('count_filestores'), result.get('filepaths')))
         else:
             print(msg_resource_cleanup
                   .format(result.get('count_deleted'), result.get('count_filestores'), result.get('filepaths')))
+            self._print_deleted_rows(result.get('deleted_rows'))
 
-    def cleanup_extras(self, key=None):
+    def cleanup_extras(self, *keys):
         """
-        Command for cleaning up the database after a key (field) has
-        been removed in the dataset schema: all records for this key
-        can then be deleted by running this command for the key.
+        Command for cleaning up the database after keys (fields) have
+        been removed in the dataset schema: all records for these keys
+        can then be deleted by running this command for the keys.
         """
-        key = self.args[1]
-        if not key:
-            print("Please provide a key for which extras should be cleaned.")
+        key_pattern = self.options.key_pattern
+        if not keys and not key_pattern:
+            print("Please provide the keys or a key pattern for which "
+                  "extras should be cleaned.")
             sys.exit(1)
         user = logic.get_action('get_site_user')({'ignore_auth': True}, {})
         context = {
@@ -366,15 +608,30 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
             print("User is not authorized to perform this action.")
             sys.exit(1)
         result = logic.get_action('cleanup_package_extra')(
-            context,
+            self._add_report(context),
             {'dryrun': self.options.dryrun,
-             'key': key})
+             'keys': list(keys),
+             'key_pattern': key_pattern})
+        if self.report:
+            self._report_summary('cleanup_extras',
+                                 count_deleted=result.get('count_deleted'),
+                                 counts=result.get('counts'),
+                                 deleted_rows=result.get('deleted_rows'))
+            return
+        requested_keys = ', '.join(
+            ["'{}'".format(key) for key in keys] +
+            (["matching '{}'".format(key_pattern)] if key_pattern else []))
+        counts = '\n'.join('- {}: {}'.format(key, count)
+                           for key, count in result['counts'].items())
         if self.options.dryrun:
             print(msg_package_extra_cleanup_dryrun
-                  .format(result.get('count_deleted'), key))
+                  .format(result.get('count_deleted'), requested_keys,
+                          counts))
         else:
             print(msg_package_extra_cleanup
-                  .format(result.get('count_deleted'), key))
+                  .format(result.get('count_deleted'), requested_keys,
+                          counts))
+            self._print_deleted_rows(result.get('deleted_rows'))
 
     def cleanup_harvestjobs(self, source=None):
         """
@@ -388,13 +645,19 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
         if len(self.args) >= 2:
             source_id = unicode(self.args[1])
             data_dict['harvest_source_id'] = source_id
-            print('cleaning up jobs for harvest source {}'.format(source_id))
+            self._print('cleaning up jobs for harvest source {}'
+                        .format(source_id))
         else:
-            print('cleaning up jobs for all harvest sources')
+            self._print('cleaning up jobs for all harvest sources')
 
         # get named arguments
         data_dict['number_of_jobs_to_keep'] = self.options.nr_of_jobs_to_keep
         data_dict['dryrun'] = self.options.dryrun
+        data_dict['resume'] = self.options.resume
+        data_dict['time_budget'] = self.options.time_budget
+        data_dict['workers'] = self.options.workers
+        data_dict['enqueue_reindex'] = self.options.enqueue_reindex
+        data_dict.update(self._throttle_options())
 
         # set context
         context = {'model': model,
@@ -412,10 +675,68 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
 
         # perform the harvest job cleanup
         result = logic.get_action(
-            'ogdch_cleanup_harvestjobs')(context, data_dict)
+            'ogdch_cleanup_harvestjobs')(self._add_report(context), data_dict)
 
         # print the result of the harvest job cleanup
-        self._print_clean_harvestjobs_result(result, data_dict)
+        if self.report:
+            self._report_summary(
+                'cleanup_harvestjobs',
+                complete=result.get('complete', True),
+                sources=dict(
+                    (source_id, {
+                        'deleted_nr_jobs': source_result['deleted_nr_jobs'],
+                        'deleted_nr_objects':
+                            source_result['deleted_nr_objects'],
+                        'deleted_rows': source_result['deleted_rows']})
+                    for source_id, source_result
+                    in result['cleanup'].items()))
+        else:
+            self._print_clean_harvestjobs_result(result, data_dict)
+
+    def cleanup_harvestobjects(self):
+        """
+        command for cleaning up the harvest objects, extras and errors
+        that are orphaned
+        """
+        context = {'model': model,
+                   'session': model.Session,
+                   'ignore_auth': True}
+        admin_user = logic.get_action('get_site_user')(context, {})
+        context['user'] = admin_user['name']
+        try:
+            logic.check_access('harvest_sources_clear', context)
+        except logic.NotAuthorized:
+            print("User is not authorized to perform this action.")
+            sys.exit(1)
+        result = logic.get_action('ogdch_cleanup_harvestobjects')(
+            self._add_report(context),
+            dict({
+                'dryrun': self.options.dryrun,
+            }, **self._throttle_options()))
+        if self.report:
+            self._report_summary('cleanup_harvestobjects',
+                                 count_deleted=result['count_deleted'],
+                                 counts=result['counts'],
+                                 deleted_rows=result['deleted_rows'])
+            return
+        counts = '\n'.join('- {}: {}'.format(table, count)
+                           for table, count in result['counts'].items())
+        if self.options.dryrun:
+            print(msg_harvestobject_cleanup_dryrun
+                  .format(result['count_deleted'], counts))
+        else:
+            print(msg_harvestobject_cleanup
+                  .format(result['count_deleted'], counts))
+            self._print_deleted_rows(result['deleted_rows'])
+
+    def _print(self, message):
+        # the report may be streamed to stdout
+        if not self.report:
+            print(message)
+
+    def _report_summary(self, command, **counts):
+        self.report.summary(command=command, dryrun=self.options.dryrun,
+                            **counts)
 
     def _print_clean_harvestjobs_result(self, result, data_dict):
         print('\nCleaning up jobs for harvest sources:\n{}\nConfiguration:'
@@ -435,6 +756,10 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
             print('\nThis has been a dry run: '
                   'if you want to perfom these changes'
                   ' run this again without the option --dryrun!')
+        elif not result.get('complete', True):
+            print('\nThe time budget is exhausted before all sources '
+                  'have been cleaned up: run this again with the option '
+                  '--resume to continue!')
         else:
             print('\nThe database has been cleaned from harvester '
                   'jobs and harvester objects.'
@@ -447,11 +772,19 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
 
     def _print_cleanup_result_per_source(self, cleanup_result):
         print('   nr jobs to delete: {0}'
-              .format(len(cleanup_result['deleted_jobs'])))
+              .format(cleanup_result['deleted_nr_jobs']))
         print('nr objects to delete: {0}'
               .format(cleanup_result['deleted_nr_objects']))
         print('      jobs to delete:')
         self._print_harvest_jobs(cleanup_result['deleted_jobs'])
+        self._print_deleted_rows(cleanup_result.get('deleted_rows'))
+
+    def _print_deleted_rows(self, deleted_rows):
+        if not deleted_rows:
+            return
+        print('Deleted rows per table:')
+        for table, count in deleted_rows.items():
+            print('- {}: {}'.format(table, count))
 
     def _print_configuration(self, data_dict):
         for k, v in data_dict.items():
@@ -470,6 +803,57 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
                           job.created.strftime('%Y-%m-%d %H:%M:%S'),
                           job.status))
 
+    def apply_plan(self, path=None):
+        """
+        command that applies a deletion plan of a cleanup command
+        :argument path: string
+        """
+        if not path:
+            print("Please provide the path of the plan to apply.")
+            sys.exit(1)
+        context = {'model': model,
+                   'session': model.Session,
+                   'ignore_auth': True}
+        admin_user = logic.get_action('get_site_user')(context, {})
+        context['user'] = admin_user['name']
+        try:
+            result = logic.get_action('ogdch_apply_cleanup_plan')(
+                self._add_report(context),
+                dict({
+                    'plan': path,
+                    'workers': self.options.workers,
+                    'enqueue_reindex': self.options.enqueue_reindex,
+                }, **self._throttle_options()))
+        except logic.ValidationError as e:
+            print(e.error_dict.get('plan', e.error_dict))
+            sys.exit(1)
+        except logic.NotAuthorized:
+            print("User is not authorized to perform this action.")
+            sys.exit(1)
+        if self.report:
+            self._report_summary('apply_plan',
+                                 plan_command=result['command'],
+                                 file_count=result['file_count'],
+                                 deleted_rows=result['deleted_rows'],
+                                 skipped=result['skipped'],
+                                 sources=result['sources'])
+            return
+        print('The plan of {} created at {} has been applied:'
+              .format(result['command'], result['created']))
+        self._print_deleted_rows(result['deleted_rows'])
+        for table, count in result['skipped'].items():
+            print('{} rows of {} have been skipped: they no longer qualify '
+                  'for deletion'.format(count, table))
+        print('{} files have been removed'.format(result['file_count']))
+        if result['sources']:
+            print('{} harvest sources have been {}'.format(
+                len(result['sources']),
+                'queued for reindexing' if self.options.enqueue_reindex
+                else 'reindexed'))
+        if result['errors']:
+            print('Following errors occured, please check those cases '
+                  'manually:\n{}'.format(result['errors']))
+
     def clear_stale_harvestsources(self, source=None):
         """
         command that clears all datasets, jobs and objects related
@@ -497,7 +881,7 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
         # test authorization
         try:
             logic.check_access('harvest_sources_clear', context, data_dict)
-            print("User is authorized to perform this action")
+            self._print("User is authorized to perform this action")
         except logic.NotAuthorized:
             print("User is not authorized to perform this action")
             sys.exit(1)
@@ -505,9 +889,15 @@ class OgdchCommands(ckan.lib.cli.CkanCommand):
         # cleanup harvest source
         nr_cleanup_harvesters = logic.get_action(
             'ogdch_cleanup_harvestsource')(
-            context, {
+            self._add_report(context), {
                 'timeframe_to_keep_harvested_datasets':
                     self.options.timeframe_to_keep_harvested_datasets
             })
+        if self.report:
+            self._report_summary(
+                'clear_stale_harvestsources',
+                count_cleared_harvestsource=nr_cleanup_harvesters[
+                    "count_cleared_harvestsource"])
+            return
         print("{} harvest sources were cleared".format(
             nr_cleanup_harvesters["count_cleared_harvestsource"]))
@@ -0,0 +1,38 @@
+# encoding: utf-8
+
+import sqlalchemy as sa
+
+from ckan import model
+
+
+def stream_ids(sql, batch_size=10000, **params):
+    """
+    yields the values of the first column of a query in batches:
+    the rows are fetched with a server-side cursor on a separate
+    connection, so that the result is never held in memory at once
+    """
+    connection = model.meta.engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True) \
+            .execute(sa.text(sql), **params)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [row[0] for row in rows]
+    finally:
+        connection.close()
+
+
+def batches(iterable, size):
+    """
+    yields the items of an iterable in lists of at most size items
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
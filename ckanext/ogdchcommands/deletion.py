@@ -0,0 +1,181 @@
+# encoding: utf-8
+
+import io
+import logging
+import time
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from ckan import model
+
+from ckanext.ogdchcommands.db import batches
+
+log = logging.getLogger(__name__)
+
+ID_TABLE = 'ogdch_delete_ids'
+LOAD_BATCH_SIZE = 10000
+
+
+def _delete_using(table, column):
+    return (table,
+            'delete from {table} t using {{ids}} d where t.{column} = d.id'
+            .format(table=table, column=column))
+
+
+# the steps are executed in order: each step is a table and a delete
+# statement that joins it with the temporary id table `{ids}`
+
+HARVEST_JOB_STEPS = [
+    ('harvest_object_error',
+     'delete from harvest_object_error e using harvest_object o, {ids} d '
+     'where e.harvest_object_id = o.id and o.harvest_job_id = d.id'),
+    ('harvest_object_extra',
+     'delete from harvest_object_extra e using harvest_object o, {ids} d '
+     'where e.harvest_object_id = o.id and o.harvest_job_id = d.id'),
+    _delete_using('harvest_object', 'harvest_job_id'),
+    _delete_using('harvest_gather_error', 'harvest_job_id'),
+    _delete_using('harvest_job', 'id'),
+]
+
+# only resources in the state 'deleted' are deleted: a resource that
+# has been restored in the meantime is kept together with its views and
+# its revisions
+RESOURCE_STEPS = [
+    ('resource_view',
+     'delete from resource_view t using {ids} d, resource r '
+     "where t.resource_id = d.id and r.id = d.id and r.state = 'deleted'"),
+    ('resource_revision',
+     'delete from resource_revision t using {ids} d, resource r '
+     "where t.continuity_id = d.id and r.id = d.id "
+     "and r.state = 'deleted'"),
+    ('resource',
+     'delete from resource t using {ids} d '
+     "where t.id = d.id and t.state = 'deleted'"),
+]
+
+PACKAGE_EXTRA_STEPS = [
+    _delete_using('package_extra_revision', 'continuity_id'),
+    _delete_using('package_extra', 'id'),
+]
+
+# orphaned harvest rows are deleted by their own ids: the errors and
+# extras of orphaned objects are orphans themselves
+
+HARVEST_OBJECT_ERROR_STEPS = [
+    _delete_using('harvest_object_error', 'id'),
+]
+
+HARVEST_OBJECT_EXTRA_STEPS = [
+    _delete_using('harvest_object_extra', 'id'),
+]
+
+HARVEST_OBJECT_STEPS = [
+    _delete_using('harvest_object', 'id'),
+]
+
+
+def delete_ids(ids, steps, session=None, throttle=None):
+    """
+    deletes the rows of all steps for the given ids in one transaction
+    and returns the number of deleted rows per table: the ids are loaded
+    into a temporary table, so that every step is a single
+    `delete ... using` statement, no matter how many ids there are.
+    With a throttle the ids are deleted in chunks of its chunk size, one
+    transaction per chunk, at the pace of the throttle.
+    """
+    session = session or model.Session
+    if throttle is None:
+        return _delete(session, steps,
+                       lambda session: _load_ids(session, ids))
+    deleted = OrderedDict()
+    for chunk in batches(ids, throttle.chunk_size):
+        counts = _delete(session, steps,
+                         lambda session: _load_ids(session, chunk), throttle)
+        add_counts(deleted, counts)
+        throttle.rows(sum(counts.values()))
+    return deleted
+
+
+def delete_selected(select, params, steps, session=None):
+    """
+    deletes the rows of all steps for the ids of a select statement in
+    one transaction: the ids are inserted into the temporary table by
+    the database, they are never loaded by the client
+    """
+    def load(session):
+        return session.execute(
+            sa.text('insert into {} (id) {}'.format(ID_TABLE, select)),
+            params).rowcount
+    return _delete(session or model.Session, steps, load)
+
+
+def _delete(session, steps, load, throttle=None):
+    deleted = OrderedDict()
+    # the backoff of slow statements is waited for after the commit or
+    # the rollback: the locks of the transaction are released by then
+    backoff = 0
+    try:
+        session.execute('create temporary table {} (id text) on commit drop'
+                        .format(ID_TABLE))
+        count = load(session)
+        session.execute('analyze {}'.format(ID_TABLE))
+        log.debug('{} ids loaded for deletion'.format(count))
+        for table, sql in steps:
+            start = time.time()
+            result = session.execute(sql.format(ids=ID_TABLE))
+            if throttle:
+                backoff += throttle.observe(time.time() - start)
+            deleted[table] = deleted.get(table, 0) + result.rowcount
+            log.debug('{} rows deleted from {}'
+                      .format(result.rowcount, table))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        if throttle:
+            throttle.back_off(backoff)
+    return deleted
+
+
+def add_counts(total, counts):
+    """
+    adds the deleted rows per table of one deletion to a total
+    """
+    for table, count in counts.items():
+        total[table] = total.get(table, 0) + count
+    return total
+
+
+def _load_ids(session, ids):
+    """
+    loads the ids into the temporary table with COPY, or with
+    a bulk insert if the database driver does not support COPY
+    """
+    cursor = session.connection().connection.cursor()
+    count = 0
+    try:
+        for batch in batches(ids, LOAD_BATCH_SIZE):
+            if hasattr(cursor, 'copy_from'):
+                cursor.copy_from(_copy_buffer(batch), ID_TABLE,
+                                 columns=('id',))
+            else:
+                cursor.executemany(
+                    'insert into {} (id) values (%s)'.format(ID_TABLE),
+                    [(id,) for id in batch])
+            count += len(batch)
+    finally:
+        cursor.close()
+    return count
+
+
+def _copy_buffer(ids):
+    data = u''.join(_copy_escape(id) + u'\n' for id in ids)
+    if isinstance(data, str):
+        return io.StringIO(data)
+    return io.BytesIO(data.encode('utf-8'))
+
+
+def _copy_escape(value):
+    return value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t') \
+        .replace(u'\n', u'\\n').replace(u'\r', u'\\r')
@@ -0,0 +1,379 @@
+# encoding: utf-8
+
+import os
+import logging
+import sqlite3
+import uuid
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+log = logging.getLogger(__name__)
+
+# the filestore stores a resource file at
+# resources/<id[0:3]>/<id[3:6]>/<id[6:]>: each top-level directory
+# is a bucket that can be scanned independently of the others
+
+
+class FilestoreIndex(object):
+    """
+    maps resource ids to the paths of their files in the filestore and
+    back: the storage root is resolved once, the paths are derived from
+    the ids without any further filesystem calls
+    """
+
+    def __init__(self, storage_path):
+        if storage_path is None:
+            raise TypeError("storage_path is not defined")
+        self.resource_path = os.path.join(os.path.realpath(storage_path),
+                                          'resources')
+
+    def path(self, resource_id):
+        # ids are only ever split into directories, never resolved
+        if not resource_id or os.sep in resource_id or \
+                resource_id.startswith('.'):
+            raise ValueError('Invalid resource id {}'.format(resource_id))
+        return os.path.join(self.resource_path, resource_id[0:3],
+                            resource_id[3:6], resource_id[6:])
+
+    def resource_id(self, filepath):
+        # filepath:    bfb/f4c/75-1efd-474c-a347-6b2690e6344b
+        # resource id: bfbf4c75-1efd-474c-a347-6b2690e6344b
+        relpath = os.path.relpath(filepath, self.resource_path)
+        return relpath.replace(os.sep, '')
+
+
+class ResourceIdSet(object):
+    """
+    a compact set of resource ids: UUIDs are stored as a sorted array of
+    16 bytes each and looked up by binary search, other ids are kept in
+    a set of strings. The ids are expected in ascending order, otherwise
+    the array is sorted once at the end.
+    """
+
+    UUID_SIZE = 16
+
+    def __init__(self, ids):
+        uuids = bytearray()
+        self.other_ids = set()
+        last = None
+        in_order = True
+        for id in ids:
+            key = _uuid_bytes(id)
+            if key is None:
+                self.other_ids.add(id)
+                continue
+            if last is not None and key < last:
+                in_order = False
+            uuids.extend(key)
+            last = key
+        if not in_order:
+            size = self.UUID_SIZE
+            uuids = bytearray(b''.join(sorted(
+                bytes(uuids[i:i + size])
+                for i in range(0, len(uuids), size))))
+        self.uuids = bytes(uuids)
+        self.count = len(self.uuids) // self.UUID_SIZE
+
+    def __len__(self):
+        return self.count + len(self.other_ids)
+
+    def __contains__(self, id):
+        key = _uuid_bytes(id)
+        if key is None:
+            return id in self.other_ids
+        size = self.UUID_SIZE
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            value = self.uuids[middle * size:(middle + 1) * size]
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return True
+        return False
+
+
+def _uuid_bytes(id):
+    """
+    returns the 16 bytes of an id in the canonical form of a UUID, whose
+    string order is the order of its bytes, or None for any other id
+    """
+    if len(id) != 36:
+        return None
+    try:
+        value = uuid.UUID(id)
+    except ValueError:
+        return None
+    if str(value) != id:
+        return None
+    return value.bytes
+
+
+def scan(resource_path, workers=1):
+    """
+    yields the paths of the files in the filestore bucket per bucket:
+    the buckets are scanned by a pool of workers, the files that are
+    not inside of a bucket come first. There are no files before the
+    first upload.
+    """
+    if not os.path.isdir(resource_path):
+        return
+    buckets, files = _list_directory(resource_path)
+    if files:
+        yield files
+    for bucket_files in _map(scan_bucket, buckets, workers):
+        if bucket_files:
+            yield bucket_files
+
+
+def scan_bucket(bucket_path):
+    """
+    returns the paths of all files in a bucket
+    """
+    files = []
+    directories = [bucket_path]
+    while directories:
+        subdirectories, subfiles = _list_directory(directories.pop())
+        directories.extend(subdirectories)
+        files.extend(subfiles)
+    return sorted(files)
+
+
+def list_directories(resource_path, workers=1):
+    """
+    returns the mtime of the filestore, of its buckets and of the
+    directories in the buckets by their path relative to the filestore:
+    there are none before the first upload
+    """
+    if not os.path.isdir(resource_path):
+        return {}
+    mtimes = {'': os.stat(resource_path).st_mtime}
+    buckets, files = _list_directory(resource_path)
+    for bucket_mtimes in _map(_directory_mtimes, buckets, workers):
+        for path, mtime in bucket_mtimes:
+            mtimes[os.path.relpath(path, resource_path)] = mtime
+    return mtimes
+
+
+def scan_changes(resource_path, manifest, workers=1):
+    """
+    yields (directory, mtime, files, new_files) for every directory
+    whose mtime differs from the one in the manifest: new_files are the
+    files that are not in the manifest yet. Directories that no longer
+    exist are removed from the manifest.
+    """
+    mtimes = list_directories(resource_path, workers)
+    known_mtimes = manifest.directory_mtimes()
+    for directory in set(known_mtimes) - set(mtimes):
+        manifest.remove_directory(directory)
+    changed = sorted(directory for directory, mtime in mtimes.items()
+                     if known_mtimes.get(directory) != mtime)
+    log.debug("{} of {} filestore directories have changed"
+              .format(len(changed), len(mtimes)))
+
+    def list_files(directory):
+        path = os.path.join(resource_path, directory)
+        # files below the second level belong to their bucket directory
+        if directory.count(os.sep) >= 1:
+            return directory, scan_bucket(path)
+        return directory, _list_directory(path)[1]
+
+    for directory, files in _map(list_files, changed, workers):
+        known_files = manifest.files(directory)
+        new_files = [filepath for filepath in files
+                     if filepath not in known_files]
+        yield directory, mtimes[directory], files, new_files
+
+
+def existing_files(filepaths, workers=1):
+    """
+    returns the filepaths that exist: the paths are probed per bucket
+    by a pool of workers
+    """
+    existing = []
+    for bucket_files in _map(_existing_files, _group_by_bucket(filepaths),
+                             workers):
+        existing.extend(bucket_files)
+    return existing
+
+
+def remove_files(filepaths, workers=1, throttle=None):
+    """
+    removes the files per bucket by a pool of workers and returns the
+    filepaths that could not be removed: the workers share the files
+    per second of the throttle
+    """
+    errors = []
+    for bucket_errors in _map(partial(_remove_files, throttle=throttle),
+                              _group_by_bucket(filepaths), workers):
+        errors.extend(bucket_errors)
+    return errors
+
+
+def _existing_files(filepaths):
+    return [filepath for filepath in filepaths if os.path.exists(filepath)]
+
+
+def _remove_files(filepaths, throttle=None):
+    errors = []
+    for filepath in filepaths:
+        if throttle:
+            throttle.files(1)
+        try:
+            log.debug("Deleting {}.".format(filepath))
+            os.remove(filepath)
+        except OSError:
+            log.error("Deleting {} caused an error and was NOT deleted. "
+                      .format(filepath))
+            errors.append(filepath)
+    return errors
+
+
+def _directory_mtimes(bucket_path):
+    """
+    returns the mtimes of a bucket and of its directories
+    """
+    mtimes = [(bucket_path, os.stat(bucket_path).st_mtime)]
+    for directory in _list_directory(bucket_path)[0]:
+        mtimes.append((directory, os.stat(directory).st_mtime))
+    return mtimes
+
+
+def _group_by_bucket(filepaths):
+    buckets = {}
+    for filepath in filepaths:
+        bucket = os.path.dirname(os.path.dirname(filepath))
+        buckets.setdefault(bucket, []).append(filepath)
+    return [buckets[bucket] for bucket in sorted(buckets)]
+
+
+def _list_directory(path):
+    """
+    returns the subdirectories and the files of a directory:
+    symlinks to directories are not followed
+    """
+    directories = []
+    files = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    directories.append(entry.path)
+            else:
+                files.append(entry.path)
+    else:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            if os.path.isdir(entry_path):
+                if not os.path.islink(entry_path):
+                    directories.append(entry_path)
+            else:
+                files.append(entry_path)
+    return sorted(directories), sorted(files)
+
+
+def _map(func, items, workers):
+    """
+    applies func to all items, in parallel if there is more than one
+    worker: the results are yielded in the order of the items
+    """
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        for result in pool.imap(func, items):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+class Manifest(object):
+    """
+    a manifest of the filestore in a SQLite file: the mtime of every
+    directory and the files in it that belong to a resource. Changes
+    are only stored when they are saved.
+    """
+
+    def __init__(self, path, resource_path):
+        self.resource_path = resource_path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            create table if not exists directories (
+                path text primary key, mtime real);
+            create table if not exists files (
+                directory text, name text, primary key (directory, name));
+        ''')
+
+    def clear(self):
+        self.connection.execute('delete from files')
+        self.connection.execute('delete from directories')
+
+    def directory_mtimes(self):
+        return dict(self.connection.execute(
+            'select path, mtime from directories'))
+
+    def files(self, directory):
+        path = os.path.join(self.resource_path, directory)
+        return set(os.path.join(path, name) for name, in
+                   self.connection.execute(
+                       'select name from files where directory = ?',
+                       (directory,)))
+
+    def update_directory(self, directory, mtime, files):
+        path = os.path.join(self.resource_path, directory)
+        self.connection.execute('delete from files where directory = ?',
+                                (directory,))
+        self.connection.executemany(
+            'insert into files (directory, name) values (?, ?)',
+            [(directory, os.path.relpath(filepath, path))
+             for filepath in files])
+        self.connection.execute(
+            'insert or replace into directories (path, mtime) values (?, ?)',
+            (directory, mtime))
+
+    def iter_files(self):
+        """
+        yields the directory and the path of every file in the manifest
+        """
+        for directory, name in self.connection.execute(
+                'select directory, name from files order by directory, name'):
+            yield directory, os.path.join(self.resource_path, directory, name)
+
+    def remove_files(self, directory, filepaths, mtime):
+        """
+        removes files of a directory that have been deleted: the deletion
+        changes the mtime of the directory
+        """
+        path = os.path.join(self.resource_path, directory)
+        self.connection.executemany(
+            'delete from files where directory = ? and name = ?',
+            [(directory, os.path.relpath(filepath, path))
+             for filepath in filepaths])
+        self.connection.execute(
+            'update directories set mtime = ? where path = ?',
+            (mtime, directory))
+
+    def remove_directory(self, directory):
+        self.connection.execute('delete from files where directory = ?',
+                                (directory,))
+        self.connection.execute('delete from directories where path = ?',
+                                (directory,))
+
+    def save(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,166 @@
+# encoding: utf-8
+
+import datetime
+import json
+import logging
+import threading
+import time
+import traceback
+import uuid
+
+from ckan import model
+from ckan.common import config
+import ckan.plugins.toolkit as tk
+
+log = logging.getLogger(__name__)
+
+STATUS_KEY = 'ogdch:job:{}'
+STATUS_TTL = 7 * 24 * 3600
+PROGRESS_INTERVAL = 1
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+
+class RedisStatusStore(object):
+    """
+    stores the status of the jobs in the Redis of CKAN, so that it can
+    be read by every web worker: the status expires after a week
+    """
+
+    def __init__(self):
+        from ckan.lib.redis import connect_to_redis
+        self.redis = connect_to_redis()
+
+    def get(self, job_id):
+        status = self.redis.get(STATUS_KEY.format(job_id))
+        return json.loads(status) if status else None
+
+    def set(self, job_id, status):
+        self.redis.setex(STATUS_KEY.format(job_id), STATUS_TTL,
+                         json.dumps(status, default=str))
+
+
+class MemoryStatusStore(object):
+    """
+    stores the status of the jobs in the memory of the process: the
+    stand-in for the jobs that are run in-process
+    """
+
+    def __init__(self):
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        with self._lock:
+            status = self.statuses.get(job_id)
+            return dict(status) if status else None
+
+    def set(self, job_id, status):
+        with self._lock:
+            self.statuses[job_id] = dict(status)
+
+
+_memory_store = MemoryStatusStore()
+
+
+def in_process():
+    return config.get('ckanext.ogdchcommands.job_queue', 'rq') == 'inprocess'
+
+
+def get_status_store():
+    if in_process():
+        return _memory_store
+    return RedisStatusStore()
+
+
+def enqueue(func, data_dict, title):
+    """
+    runs func(data_dict, progress) as a background job and returns the id
+    of the job: the job is enqueued on the job queue of CKAN, or run in a
+    thread of this process if the job queue is configured as `inprocess`
+    """
+    job_id = str(uuid.uuid4())
+    get_status_store().set(job_id, {
+        'id': job_id,
+        'title': title,
+        'status': QUEUED,
+        'enqueued': datetime.datetime.utcnow().isoformat(),
+    })
+    if in_process():
+        thread = threading.Thread(target=_run_in_thread,
+                                  args=(func, job_id, data_dict))
+        thread.daemon = True
+        thread.start()
+    else:
+        tk.enqueue_job(run, [func, job_id, data_dict], title=title)
+    log.info('Job {} ({}) enqueued'.format(job_id, title))
+    return job_id
+
+
+def run(func, job_id, data_dict):
+    """
+    runs a job and records its status, its progress and its result
+    """
+    progress = Progress(job_id)
+    progress.update_status(status=RUNNING,
+                           started=datetime.datetime.utcnow().isoformat())
+    try:
+        result = func(data_dict, progress)
+    except Exception as e:
+        log.error('Job {} failed: {}'.format(job_id, e))
+        progress.update_status(status=FAILED, error=str(e),
+                               traceback=traceback.format_exc(),
+                               **progress.counts())
+        return
+    progress.update_status(status=FINISHED, result=result,
+                           finished=datetime.datetime.utcnow().isoformat(),
+                           **progress.counts())
+
+
+def _run_in_thread(func, job_id, data_dict):
+    try:
+        run(func, job_id, data_dict)
+    finally:
+        model.Session.remove()
+
+
+class Progress(object):
+    """
+    the progress of a job: it is written to the status of the job at
+    most once every PROGRESS_INTERVAL seconds
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.store = get_status_store()
+        self.start = time.time()
+        self.done = 0
+        self.total = None
+        self._last_update = 0
+
+    def __call__(self, done, total=None):
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.time()
+        if now - self._last_update >= PROGRESS_INTERVAL:
+            self._last_update = now
+            self.update_status(**self.counts())
+
+    def counts(self):
+        duration = time.time() - self.start
+        return {
+            'done': self.done,
+            'total': self.total,
+            'duration': round(duration, 2),
+            'items_per_second':
+                round(self.done / duration, 2) if duration else self.done,
+        }
+
+    def update_status(self, **fields):
+        status = self.store.get(self.job_id) or {'id': self.job_id}
+        status.update(fields)
+        self.store.set(self.job_id, status)
@@ -0,0 +1,84 @@
+# encoding: utf-8
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """
+    a checkpoint journal of a cleanup run in a JSON file: it records the
+    state of every source and the number of jobs that have been deleted
+    so far, so that an interrupted run can be resumed. The journal of a
+    previous run is only read with `resume` and only if it was written
+    with the same configuration, otherwise it is discarded.
+    """
+
+    # states of a source
+    DELETING = 'deleting'
+    DELETED = 'deleted'
+    DONE = 'done'
+
+    def __init__(self, path, configuration, resume=False):
+        self.path = path
+        self.configuration = configuration
+        self.sources = {}
+        self._lock = threading.Lock()
+        if resume:
+            self._load()
+        else:
+            self.remove()
+
+    def _load(self):
+        try:
+            with open(self.path) as journal_file:
+                journal = json.load(journal_file)
+        except IOError:
+            log.info('No journal found at {}: nothing to resume'
+                     .format(self.path))
+            return
+        except ValueError:
+            log.warning('The journal at {} cannot be read: starting over'
+                        .format(self.path))
+            return
+        if journal.get('configuration') != self.configuration:
+            log.warning('The journal at {} was written with the '
+                        'configuration {}: starting over'
+                        .format(self.path, journal.get('configuration')))
+            return
+        self.sources = journal.get('sources', {})
+        log.info('Resuming the run of the journal at {}: {} sources done'
+                 .format(self.path, len([
+                     source for source in self.sources.values()
+                     if source['state'] == self.DONE])))
+
+    def state(self, source_id):
+        return self.sources.get(source_id, {}).get('state')
+
+    def update(self, source_id, state, deleted_jobs=0):
+        """
+        records the state of a source and saves the journal: the
+        sources may be updated by several threads
+        """
+        with self._lock:
+            source = self.sources.setdefault(source_id, {'deleted_jobs': 0})
+            source['state'] = state
+            source['deleted_jobs'] += deleted_jobs
+            self.save()
+
+    def save(self):
+        # an interrupted write must never corrupt the journal
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as journal_file:
+            json.dump({'configuration': self.configuration,
+                       'sources': self.sources}, journal_file)
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
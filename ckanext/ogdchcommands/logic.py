@@ -1,13 +1,27 @@
-import itertools
-
 from ckan.logic import NotFound, ValidationError
 import ckan.plugins.toolkit as tk
 from ckan import model
-from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
+from ckanext.harvest.model import HarvestSource
 import datetime
+import time
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 import os
-import re
+import sqlalchemy as sa
+from six import string_types
 from ckan.common import config
+from ckanext.datastore.backend.postgres import get_write_engine
+from ckanext.ogdchcommands import filestore, metrics, report
+from ckanext.ogdchcommands.db import batches, stream_ids
+from ckanext.ogdchcommands.deletion import (
+    add_counts, delete_ids, delete_selected,
+    HARVEST_JOB_STEPS, RESOURCE_STEPS, PACKAGE_EXTRA_STEPS,
+    HARVEST_OBJECT_ERROR_STEPS, HARVEST_OBJECT_EXTRA_STEPS,
+    HARVEST_OBJECT_STEPS)
+from ckanext.ogdchcommands.journal import Journal
+from ckanext.ogdchcommands.plan import Plan, PlanError, get_plan
+from ckanext.ogdchcommands.reindex import ReindexQueue
+from ckanext.ogdchcommands.throttle import get_throttle
 
 import logging
 log = logging.getLogger(__name__)
@@ -16,8 +30,57 @@ storage_path = config.get('ckan.storage_path')
 FORMAT_TURTLE = 'ttl'
 DATA_IDENTIFIER = 'data'
 RESULT_IDENTIFIER = 'result'
+RESOURCE_BATCH_SIZE = 10000
+DATASTORE_PAGE_SIZE = 1000
+FILESTORE_MANIFEST = 'ogdch_filestore_manifest.sqlite'
+FILESTORE_MANIFEST_BATCH_SIZE = 1000
+HARVESTJOBS_JOURNAL = 'ogdch_harvestjobs_journal.json'
+HARVEST_OBJECT_BATCH_SIZE = 50000
+HARVEST_ORPHAN_BATCH_SIZE = 10000
+
+# the permission that is needed to apply the deletion plan of a command
+PLAN_ACCESS = {
+    'cleanup_harvestjobs': 'harvest_sources_clear',
+    'cleanup_resources': 'resource_delete',
+    'cleanup_filestore': 'resource_delete',
+    'cleanup_extras': 'package_delete',
+    'cleanup_harvestobjects': 'harvest_sources_clear',
+}
+
+# harvest objects whose job or package no longer exists: every
+# condition is an anti-join of its own, the union removes duplicates
+ORPHANED_HARVEST_OBJECTS = '''select o.id from harvest_object o
+    where o.harvest_job_id is not null and not exists (
+        select 1 from harvest_job j where j.id = o.harvest_job_id)
+    union
+    select o.id from harvest_object o
+    where o.package_id is not null and not exists (
+        select 1 from package p where p.id = o.package_id)'''
 
+# rows of a table that belong to a harvest object that no longer exists
+# or to an orphaned harvest object
+ORPHANED_HARVEST_OBJECT_ROWS = '''select t.id from {table} t
+    where not exists (
+        select 1 from harvest_object o where o.id = t.harvest_object_id)
+    union
+    select t.id from {table} t
+    join (''' + ORPHANED_HARVEST_OBJECTS + ''') orphans
+        on orphans.id = t.harvest_object_id'''
 
+# the orphans are deleted in this order: the errors and extras of the
+# orphaned objects are deleted before the objects themselves
+HARVEST_ORPHAN_STEPS = [
+    ('harvest_object_error',
+     ORPHANED_HARVEST_OBJECT_ROWS.format(table='harvest_object_error'),
+     HARVEST_OBJECT_ERROR_STEPS),
+    ('harvest_object_extra',
+     ORPHANED_HARVEST_OBJECT_ROWS.format(table='harvest_object_extra'),
+     HARVEST_OBJECT_EXTRA_STEPS),
+    ('harvest_object', ORPHANED_HARVEST_OBJECTS, HARVEST_OBJECT_STEPS),
+]
+
+
+@metrics.instrument('ogdch_cleanup_harvestjobs')
 def ogdch_cleanup_harvestjobs(context, data_dict):
     """
     cleans up the database for harvest objects and related tables for all
@@ -54,240 +117,917 @@ def ogdch_cleanup_harvestjobs(context, data_dict):
         raise ValidationError(
             'Configuration missing for number of harvest jobs to keep')
 
-    dryrun = data_dict.get("dryrun", False)
+    # with a plan in the context the jobs are planned instead of deleted
+    dryrun = data_dict.get("dryrun", False) or get_plan(context) is not None
+    workers = int(data_dict.get('workers', 1))
+    throttle = get_throttle(data_dict)
 
     log.info('Harvest job cleanup called for sources: {},'
              'configuration: {}'.format(
                  ', '.join([s.id for s in sources_to_cleanup]),
                  data_dict))
 
-    # store cleanup result
-    cleanup_result = {}
-    for source in sources_to_cleanup:
+    # with a journal an interrupted run can be resumed: the jobs to
+    # delete are selected again, sources that are done are skipped.
+    # Without a path for the journal the progress is not recorded, unless
+    # it is needed to resume the run.
+    resume = data_dict.get('resume', False)
+    time_budget = data_dict.get('time_budget')
+    journal = None
+    journal_path = _get_journal_path(required=bool(resume or time_budget))
+    if not dryrun and journal_path:
+        journal = Journal(
+            journal_path,
+            {'number_of_jobs_to_keep': number_of_jobs_to_keep,
+             'harvest_source_id': data_dict.get('harvest_source_id')},
+            resume=resume)
+    deadline = time.time() + float(time_budget) if time_budget else None
+
+    # select the jobs to delete for all sources in one query
+    with metrics.phase(context, 'select'):
+        jobs_per_source = _get_harvest_jobs_to_delete(
+            number_of_jobs_to_keep, data_dict.get('harvest_source_id'))
 
-        # get jobs ordered by their creations date
-        delete_jobs = model.Session.query(HarvestJob) \
-            .filter(HarvestJob.source_id == source.id) \
-            .filter(HarvestJob.status == 'Finished') \
-            .order_by(HarvestJob.created.desc()).all()[number_of_jobs_to_keep:]
+    # the sources to clean up with their jobs to delete
+    source_jobs = []
+    for source in sources_to_cleanup:
+        state = journal.state(source.id) if journal else None
+        if state == Journal.DONE:
+            log.debug('Cleanup harvest jobs for source {}: already done '
+                      'by the resumed run'.format(source.id))
+            continue
 
-        # decide which jobs to keep or delete on their order
-        delete_jobs_ids = [job.id for job in delete_jobs]
+        # jobs are ordered by their creation date
+        delete_jobs = jobs_per_source.get(source.id, [])
 
-        if not delete_jobs:
+        # a source whose jobs have been deleted still needs a reindex
+        if not delete_jobs and state is None:
             log.debug(
                 'Cleanup harvest jobs for source {}: nothing to do'
                 .format(source.id))
-        else:
-            # log all job for a source with the decision to delete or keep them
-            log.debug('Cleanup harvest jobs for source {}: delete jobs: {}'
-                      .format(source.id, delete_jobs_ids))
-
-            # get harvest objects for harvest jobs
-            delete_objects_ids = \
-                model.Session.query(HarvestObject.id) \
-                .filter(HarvestObject.harvest_job_id.in_(
-                    delete_jobs_ids)).all()
-            delete_objects_ids = list(itertools.chain(
-                *delete_objects_ids))
-
-            # log all objects to delete
-            log.debug(
-                'Cleanup harvest objects for source {}: delete {} objects'
-                .format(source.id, len(delete_objects_ids)))
-
-            # perform delete
-            sql = '''begin;
-            delete from harvest_object_error
-            where harvest_object_id in ('{delete_objects_values}');
-            delete from harvest_object_extra
-            where harvest_object_id in ('{delete_objects_values}');
-            delete from harvest_object
-            where id in ('{delete_objects_values}');
-            delete from harvest_gather_error
-            where harvest_job_id in ('{delete_jobs_values}');
-            delete from harvest_job
-            where id in ('{delete_jobs_values}');
-            commit;
-            '''.format(delete_objects_values="','".join(delete_objects_ids),
-                       delete_jobs_values="','".join(delete_jobs_ids))
-
-            # only execute the sql if it is not a dry run
-            if not dryrun:
-                model.Session.execute(sql)
-
-                # reindex after deletions
-                tk.get_action('harvest_source_reindex')(
-                    context, {'id': source.id})
-
-            # fill result
-            cleanup_result[source.id] = {
-                'deleted_jobs': delete_jobs,
-                'deleted_nr_objects': len(delete_objects_ids)}
-
-            log.info(
-                'cleaned up harvest jobs for harvest source {}'
-                .format(source.id))
+            continue
+        source_jobs.append((source.id, delete_jobs))
+
+    # the sources are reindexed together once their jobs are deleted
+    reindex_queue = ReindexQueue()
+
+    def cleanup_source(source_id, delete_jobs):
+        if _budget_exhausted(deadline):
+            return None, False
+        # actions may change their context: every source gets its own
+        return _cleanup_harvest_source_jobs(
+            dict(context), source_id, delete_jobs, dryrun, journal, deadline,
+            reindex_queue, throttle)
+
+    # store cleanup result: the sources are independent of each other
+    # and are cleaned up by a pool of workers
+    cleanup_result = {}
+    complete = True
+    for (source_id, delete_jobs), (source_result, source_complete) in zip(
+            source_jobs,
+            _map_sources(cleanup_source, source_jobs, workers)):
+        if source_result is not None:
+            cleanup_result[source_id] = source_result
+        complete = complete and source_complete
+
+    with metrics.phase(context, 'reindex'):
+        reindexed_source_ids = reindex_queue.flush(
+            context, background=data_dict.get('enqueue_reindex', False))
+    if journal:
+        for source_id in reindexed_source_ids:
+            journal.update(source_id, Journal.DONE)
+
+    if journal and complete:
+        journal.remove()
+    elif not complete:
+        log.info('The time budget of {}s is exhausted: the cleanup can be '
+                 'resumed'.format(time_budget))
+
+    metrics.gauge(context, 'harvest_object_rows',
+                  _estimate_row_count('harvest_object'))
+    _gauge_throttle(context, throttle)
 
     # return result of action
     return {'sources': sources_to_cleanup,
-            'cleanup': cleanup_result}
+            'cleanup': cleanup_result,
+            'complete': complete}
 
-def get_path(id):
-        directory = get_directory(id)
-        filepath = os.path.join(directory, id[6:])
 
-        if filepath != os.path.realpath(filepath):
-            raise ValidationError({'upload': ['Invalid storage path']})
+def _cleanup_harvest_source_jobs(context, source_id, delete_jobs, dryrun,
+                                 journal, deadline, reindex_queue, throttle):
+    """
+    deletes the jobs of a source in chunks of a bounded number of harvest
+    objects: every chunk is committed and recorded in the journal before
+    the next one starts. The source is queued for reindexing once all of
+    its jobs are deleted. Returns the result of the source and whether
+    it is complete.
+    """
+    delete_jobs_ids = [job.id for job in delete_jobs]
 
-        return filepath
+    # log all job for a source with the decision to delete or keep them
+    log.debug('Cleanup harvest jobs for source {}: delete jobs: {}'
+              .format(source_id, delete_jobs_ids))
 
-def get_directory(id):
-        if storage_path is None:
-            raise TypeError("storage_path is not defined")
+    # count harvest objects for harvest jobs
+    delete_nr_objects = sum(job.nr_objects for job in delete_jobs)
 
-        real_storage = os.path.realpath(storage_path)
-        directory = os.path.join(real_storage, id[0:3], id[3:6])
-        if directory != os.path.realpath(directory):
-            raise ValidationError({
-                'upload': ['Invalid storage directory']
-            })
-        return directory
+    # log all objects to delete
+    log.debug(
+        'Cleanup harvest objects for source {}: delete {} objects'
+        .format(source_id, delete_nr_objects))
 
-def ogdch_cleanup_resources(context, data_dict):
+    # only perform the delete if it is not a dry run
+    deleted_jobs = delete_jobs
+    deleted_rows = OrderedDict()
+    complete = True
+    if dryrun:
+        _report_jobs(context, delete_jobs)
+        deletion_plan = get_plan(context)
+        if deletion_plan is not None:
+            deletion_plan.add_ids('harvest_job', delete_jobs_ids)
+            deletion_plan.add_source(source_id)
+    else:
+        deleted_jobs = []
+        for chunk in _chunk_jobs(delete_jobs, HARVEST_OBJECT_BATCH_SIZE):
+            if _budget_exhausted(deadline):
+                complete = False
+                break
+            with metrics.phase(context, 'delete'):
+                add_counts(deleted_rows, delete_ids(
+                    [job.id for job in chunk], HARVEST_JOB_STEPS,
+                    throttle=throttle))
+            deleted_jobs.extend(chunk)
+            if journal:
+                journal.update(source_id, Journal.DELETING, len(chunk))
+            _report_jobs(context, chunk)
+        metrics.count_rows(context, deleted_rows)
+
+        if complete:
+            if journal:
+                journal.update(source_id, Journal.DELETED)
+
+            # reindex after deletions
+            reindex_queue.add_source(source_id)
+
+    deleted_nr_objects = sum(job.nr_objects for job in deleted_jobs)
+    metrics.count(context, 'jobs_deleted', len(deleted_jobs))
+    metrics.count(context, 'objects_deleted', deleted_nr_objects)
+
+    if complete:
+        log.info(
+            'cleaned up harvest jobs for harvest source {}'
+            .format(source_id))
+
+    # fill result: with a report the jobs have been reported already
+    deleted_nr_jobs = len(deleted_jobs)
+    if report.get_report(context):
+        deleted_jobs = []
+    return {'deleted_jobs': deleted_jobs,
+            'deleted_nr_jobs': deleted_nr_jobs,
+            'deleted_nr_objects': deleted_nr_objects,
+            'deleted_rows': deleted_rows}, complete
+
+
+def _get_journal_path(required=False):
     """
-    cleans up the database from resources that have been deleted
+    returns the path of the journal: the path in the config, or the
+    default file in the storage if there is one. Without either there is
+    no journal, which is an error only if it is required.
     """
+    path = config.get('ckanext.ogdchcommands.harvestjobs_journal')
+    if path:
+        return path
+    if storage_path:
+        return os.path.join(storage_path, HARVESTJOBS_JOURNAL)
+    if required:
+        log.error('Configuration missing for the journal of the harvest '
+                  'job cleanup')
+        raise ValidationError(
+            'Configuration missing for the journal of the harvest job '
+            'cleanup: set ckanext.ogdchcommands.harvestjobs_journal or '
+            'ckan.storage_path to resume the run or to set a time budget')
+    return None
 
 
-    dryrun = data_dict.get('dryrun')
-    tk.check_access('resource_delete', context, data_dict)
-    delete_resources = model.Session.query(model.Resource) \
-        .filter(model.Resource.state == 'deleted') \
-        .all()
-    delete_resources_ids = [resource.id for resource in delete_resources]
-    count = len(delete_resources_ids)
-
-    sql = '''begin;
-    delete from resource_view
-    where resource_id in ('{delete_id_values}');
-    delete from resource_revision
-    where continuity_id in ('{delete_id_values}');
-    delete from resource
-    where id in ('{delete_id_values}');
-    commit;
-    '''.format(delete_id_values="','".join(delete_resources_ids))
+def _report_jobs(context, jobs):
+    for job in jobs:
+        report.record(context, 'harvest_job', id=job.id,
+                      source_id=job.source_id, created=job.created,
+                      status=job.status, nr_objects=job.nr_objects)
+
+
+def _map_sources(func, source_jobs, workers):
+    """
+    applies func to the jobs of every source and returns the results in
+    the order of the sources: with more than one worker the sources are
+    processed by a pool of threads. The scoped session of SQLAlchemy is
+    local to a thread, so every worker uses its own session, which is
+    returned to the connection pool after every source.
+    """
+    if workers <= 1 or len(source_jobs) <= 1:
+        return [func(source_id, jobs) for source_id, jobs in source_jobs]
+
+    def run(args):
+        try:
+            return func(*args)
+        finally:
+            model.Session.remove()
+
+    pool = ThreadPool(min(workers, len(source_jobs)))
+    try:
+        return pool.map(run, source_jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _chunk_jobs(jobs, max_objects):
+    """
+    yields the jobs in chunks of at most max_objects harvest objects: a
+    job with more objects is a chunk of its own
+    """
+    chunk = []
+    nr_objects = 0
+    for job in jobs:
+        if chunk and nr_objects + job.nr_objects > max_objects:
+            yield chunk
+            chunk = []
+            nr_objects = 0
+        chunk.append(job)
+        nr_objects += job.nr_objects
+    if chunk:
+        yield chunk
+
+
+def _budget_exhausted(deadline):
+    return deadline is not None and time.time() > deadline
+
+
+def _get_harvest_jobs_to_delete(number_of_jobs_to_keep, source_id=None):
+    """
+    selects the finished jobs to delete for all sources or a single
+    source with one query: all jobs except the latest n of each source
+    are returned per source, together with their number of objects
+    """
+    source_filter = ''
+    if source_id:
+        source_filter = 'and source_id = :source_id'
+    sql = '''select jobs.id, jobs.source_id, jobs.created, jobs.status,
+        (select count(*) from harvest_object o
+         where o.harvest_job_id = jobs.id) as nr_objects
+    from (
+        select id, source_id, created, status,
+            row_number() over (partition by source_id
+                               order by created desc) as job_number
+        from harvest_job
+        where status = 'Finished' {source_filter}
+    ) jobs
+    where jobs.job_number > :keep
+    order by jobs.source_id, jobs.created desc
+    '''.format(source_filter=source_filter)
+    rows = model.Session.execute(
+        sa.text(sql),
+        {'keep': number_of_jobs_to_keep, 'source_id': source_id})
+    jobs_per_source = {}
+    for job in rows:
+        jobs_per_source.setdefault(job.source_id, []).append(job)
+    return jobs_per_source
+
+
+def _gauge_throttle(context, throttle):
+    if throttle:
+        metrics.gauge(context, 'throttle_wait_seconds',
+                      round(throttle.waited, 3))
+
+
+def _estimate_row_count(table):
+    """
+    returns the number of rows of a table as estimated by the planner,
+    which is much cheaper than counting them
+    """
+    return model.Session.execute(
+        sa.text('select reltuples from pg_class where relname = :table'),
+        {'table': table}).scalar() or 0
 
-    if not dryrun:
-        model.Session.execute(sql)
-        log.debug("{} resources have been deleted together with their "
-                  "dependencies: resource_revision and resource_view"
-                  .format(count))
 
+@metrics.instrument('ogdch_cleanup_harvestobjects')
+def ogdch_cleanup_harvestobjects(context, data_dict):
+    """
+    cleans up the harvest objects whose job or package no longer exists
+    and the harvest object extras and errors whose object no longer
+    exists or is orphaned: the orphans of every table are found with one
+    query, a union of one anti-join per condition, their ids are
+    streamed and deleted in batches.
+    With `dryrun` the orphans are only counted per table, with a plan in
+    the context their ids are added to the plan.
+    """
+    tk.check_access('harvest_sources_clear', context, data_dict)
+    deletion_plan = get_plan(context)
+    dryrun = data_dict.get('dryrun') or deletion_plan is not None
+    batch_size = int(data_dict.get('batch_size', HARVEST_ORPHAN_BATCH_SIZE))
+    throttle = get_throttle(data_dict)
+
+    counts = OrderedDict()
+    deleted_rows = OrderedDict()
+    for table, select, steps in HARVEST_ORPHAN_STEPS:
+        if dryrun and deletion_plan is None:
+            with metrics.phase(context, 'select'):
+                counts[table] = model.Session.execute(sa.text(
+                    'select count(*) from ({}) orphans'.format(select))
+                ).scalar()
+            log.debug('{} orphaned rows found in {}'
+                      .format(counts[table], table))
+            continue
+
+        counts[table] = 0
+        for ids in metrics.timed(context, 'select',
+                                 stream_ids(select, batch_size=batch_size)):
+            counts[table] += len(ids)
+            for id in ids:
+                report.record(context, table, id=id)
+            if deletion_plan is not None:
+                deletion_plan.add_ids(table, ids)
+                continue
+            with metrics.phase(context, 'delete'):
+                add_counts(deleted_rows,
+                           delete_ids(ids, steps, throttle=throttle))
+        log.debug('{} orphaned rows {} from {}'.format(
+            counts[table], 'found' if dryrun else 'deleted', table))
+
+    metrics.count_rows(context, deleted_rows)
+    metrics.gauge(context, 'harvest_object_rows',
+                  _estimate_row_count('harvest_object'))
+    _gauge_throttle(context, throttle)
+
+    return {
+        "counts": counts,
+        "count_deleted": sum(counts.values()),
+        "dryrun": dryrun,
+        "deleted_rows": deleted_rows,
+    }
+
+
+@metrics.instrument('ogdch_cleanup_resources')
+def ogdch_cleanup_resources(context, data_dict):
+    """
+    cleans up the database from resources that have been deleted:
+    the ids of the deleted resources are streamed and processed in
+    batches, so that memory stays flat no matter how many there are.
+    With a plan in the context the resources and their files are added
+    to the plan instead of being deleted.
+    """
+    deletion_plan = get_plan(context)
+    dryrun = data_dict.get('dryrun') or deletion_plan is not None
+    batch_size = int(data_dict.get('batch_size', RESOURCE_BATCH_SIZE))
+    workers = int(data_dict.get('workers', 1))
+    throttle = get_throttle(data_dict)
+    tk.check_access('resource_delete', context, data_dict)
+    index = filestore.FilestoreIndex(storage_path)
+
+    # with a report the resources and files are reported batch by batch
+    # instead of being collected for the result
+    has_report = report.get_report(context) is not None
+    count = 0
+    count_filestores = 0
+    count_errors = 0
+    deleted_rows = OrderedDict()
     filepaths = []
-    # check the FileStore for artifacts of that resource
-    for id in delete_resources_ids:
-        directory = get_directory(id)
-        filepath = get_path(id)
-        if os.path.exists(filepath):
-            filepaths.append(str(filepath))
+    for delete_resources_ids in metrics.timed(context, 'select', stream_ids(
+            "select id from resource where state = 'deleted'",
+            batch_size=batch_size)):
+        count += len(delete_resources_ids)
+        for id in delete_resources_ids:
+            report.record(context, 'resource', id=id)
+        if deletion_plan is not None:
+            deletion_plan.add_ids('resource', delete_resources_ids)
+
+        if not dryrun:
+            with metrics.phase(context, 'delete'):
+                add_counts(deleted_rows,
+                           delete_ids(delete_resources_ids, RESOURCE_STEPS,
+                                      throttle=throttle))
+            log.debug("{} resources have been deleted together with their "
+                      "dependencies: resource_revision and resource_view"
+                      .format(len(delete_resources_ids)))
+
+        # check the FileStore for artifacts of that resource
+        with metrics.phase(context, 'filesystem_walk'):
+            batch_filepaths = filestore.existing_files(
+                [index.path(id) for id in delete_resources_ids], workers)
 
+        failed = []
+        if deletion_plan is not None:
+            deletion_plan.add_files(batch_filepaths)
+        if not dryrun:
+            with metrics.phase(context, 'file_removal'):
+                failed = filestore.remove_files(batch_filepaths, workers,
+                                                throttle)
+        count_filestores += len(batch_filepaths)
+        count_errors += len(failed)
+        if has_report:
+            _report_files(context, batch_filepaths, failed, dryrun)
+        else:
+            filepaths.extend(batch_filepaths)
+
+    metrics.count_rows(context, deleted_rows)
+    metrics.count(context, 'resources_deleted', count)
     if not dryrun:
-        for filepath in filepaths:
-            try:
-                log.info("Deleting {}.".format(filepath))
-                os.remove(filepath)
-            except OSError:
-                log.error("Deleting {} caused an error and was NOT deleted. ".format(filepath))
-                pass
+        metrics.count(context, 'files_removed',
+                      count_filestores - count_errors)
+        metrics.count(context, 'errors', count_errors)
+    _gauge_throttle(context, throttle)
+
     return {
         "count_deleted": count,
         "dryrun": dryrun,
-        "count_filestores": len(filepaths),
+        "count_filestores": count_filestores,
         "filepaths": filepaths,
+        "deleted_rows": deleted_rows,
     }
 
-def get_resource_id(filepath):
-    # filepath:    bfb/f4c/75-1efd-474c-a347-6b2690e6344b
-    # resource id: bfbf4c75-1efd-474c-a347-6b2690e6344b
-    return re.sub(r'\/', '', filepath)
 
+def _report_files(context, filepaths, failed, dryrun):
+    failed = set(failed)
+    for filepath in filepaths:
+        report.record(context, 'file', path=filepath,
+                      removed=not dryrun and filepath not in failed)
+
+
+def _get_resource_ids(state='active'):
+    """
+    loads the ids of all resources in a given state with one streamed
+    query into a compact set: the byte order of the "C" collation is the
+    order of the set
+    """
+    def iter_ids():
+        for ids in stream_ids(
+                'select id from resource where state = :state '
+                'order by id collate "C"', state=state):
+            for id in ids:
+                yield id
+    return filestore.ResourceIdSet(iter_ids())
+
+
+@metrics.instrument('ogdch_cleanup_filestore')
 def ogdch_cleanup_filestore(context, data_dict):
     """
     cleans up the filestore files that are no longer associated to any resources.
+    the buckets of the filestore are scanned by `workers` threads.
+    with `incremental` only the directories that have changed since the
+    last run are scanned, `full` rescans all of them.
+    With a plan in the context the orphans are added to the plan instead
+    of being removed.
     """
-    dryrun = data_dict.get('dryrun')
-    resource_path = storage_path + "/resources/"
+    dryrun = data_dict.get('dryrun') or get_plan(context) is not None
+    workers = int(data_dict.get('workers', 1))
+    throttle = get_throttle(data_dict)
+    tk.check_access('resource_delete', context, data_dict)
+    index = filestore.FilestoreIndex(storage_path)
+    resource_path = index.resource_path
     filepaths = []
     errors = []
 
-    for subdir, dirs, files in os.walk(resource_path):
-        for file in files:
-            fullpath = os.path.join(subdir, file)
-            relpath = os.path.relpath(fullpath, resource_path)
-            resource_id = get_resource_id(relpath)
+    if data_dict.get('incremental') or data_dict.get('full'):
+        return _cleanup_filestore_incremental(
+            context, index, dryrun, workers, data_dict.get('full'),
+            throttle)
 
-            tk.check_access('resource_show', context, {'id': resource_id})
-            try:
-                tk.get_action('resource_show')(
-                    context,
-                    {'id': resource_id}
-                )
-            except NotFound:
-                filepaths.append(os.path.join(subdir, file))
-                pass
-            except Exception as e:
-                errors.append({ 'filepath': relpath,
-                                'resource_id': resource_id,
-                                'exception': e.message,
-                                })
-                pass
+    # resource_show only finds active resources: files of resources
+    # in any other state are orphaned as well
+    with metrics.phase(context, 'select'):
+        resource_ids = _get_resource_ids()
+    log.debug("{} active resources found in the database"
+              .format(len(resource_ids)))
 
-    if not dryrun:
-        for filepath in filepaths:
-            try:
-                log.debug("Deleting {}.".format(filepath))
-                os.remove(filepath)
-            except OSError:
-                log.error("Deleting {} caused an error and was NOT deleted. ".format(filepath))
-                pass
+    # the orphans are removed bucket by bucket while the filestore is
+    # scanned: with a report they are not collected for the result
+    file_count = 0
+    for files in metrics.timed(context, 'filesystem_walk',
+                               filestore.scan(resource_path, workers)):
+        orphans = [fullpath for fullpath in files
+                   if index.resource_id(fullpath) not in resource_ids]
+
+        failed = []
+        if not dryrun and orphans:
+            with metrics.phase(context, 'file_removal'):
+                failed = filestore.remove_files(orphans, workers, throttle)
+            metrics.count(context, 'files_removed',
+                          len(orphans) - len(failed))
+            for filepath in failed:
+                _add_error(context, errors, {
+                    'filepath': filepath,
+                    'resource_id': index.resource_id(filepath),
+                    'exception': 'could not be deleted',
+                })
+        file_count += len(orphans)
+        _add_files(context, filepaths, orphans, failed, dryrun)
+
+    _gauge_throttle(context, throttle)
     return {
-        "file_count": len(filepaths),
+        "file_count": file_count,
         "filepaths": filepaths,
         "errors": errors,
     }
 
+
+def _add_files(context, filepaths, files, failed, dryrun):
+    """
+    adds files to the filepaths of the result, or reports them if there
+    is a report, and to the plan if there is one
+    """
+    deletion_plan = get_plan(context)
+    if deletion_plan is not None:
+        deletion_plan.add_files(files)
+    if report.get_report(context) is None:
+        filepaths.extend(files)
+    else:
+        _report_files(context, files, failed, dryrun)
+
+
+def _add_error(context, errors, error):
+    """
+    adds an error to the errors of the result, or reports it if there
+    is a report
+    """
+    metrics.count(context, 'errors')
+    if report.get_report(context) is None:
+        errors.append(error)
+    else:
+        report.record(context, 'error', **error)
+
+
+def _cleanup_filestore_incremental(context, index, dryrun, workers,
+                                   full, throttle):
+    """
+    cleans up the filestore directories that have changed since the last
+    run: only their new files are checked against the database. The
+    manifest of the filestore is rebuilt from scratch with `full`.
+    """
+    resource_path = index.resource_path
+    manifest = filestore.Manifest(
+        config.get('ckanext.ogdchcommands.filestore_manifest',
+                   os.path.join(storage_path, FILESTORE_MANIFEST)),
+        resource_path)
+    file_count = 0
+    filepaths = []
+    errors = []
+    try:
+        if full:
+            manifest.clear()
+        changes = filestore.scan_changes(resource_path, manifest, workers)
+        for batch in metrics.timed(
+                context, 'filesystem_walk',
+                batches(changes, FILESTORE_MANIFEST_BATCH_SIZE)):
+            new_files = {}
+            for directory, mtime, files, directory_new_files in batch:
+                for fullpath in directory_new_files:
+                    new_files[fullpath] = index.resource_id(fullpath)
+            orphaned_ids = set()
+            if new_files:
+                with metrics.phase(context, 'select'):
+                    orphaned_ids.update(
+                        _get_orphaned_resource_ids(set(new_files.values())))
+
+            for directory, mtime, files, directory_new_files in batch:
+                orphans = [fullpath for fullpath in directory_new_files
+                           if new_files[fullpath] in orphaned_ids]
+                file_count += len(orphans)
+                if dryrun:
+                    _add_files(context, filepaths, orphans, [], dryrun)
+                    continue
+                with metrics.phase(context, 'file_removal'):
+                    failed = filestore.remove_files(orphans, workers,
+                                                    throttle)
+                metrics.count(context, 'files_removed',
+                              len(orphans) - len(failed))
+                _add_files(context, filepaths, orphans, failed, dryrun)
+                if failed:
+                    # the directory is scanned again on the next run
+                    for filepath in failed:
+                        _add_error(context, errors, {
+                            'filepath': filepath,
+                            'resource_id': new_files[filepath],
+                            'exception': 'could not be deleted',
+                        })
+                    continue
+                if orphans:
+                    mtime = os.stat(
+                        os.path.join(resource_path, directory)).st_mtime
+                manifest.update_directory(
+                    directory, mtime, set(files) - set(orphans))
+        # a full run has just checked every file against the database
+        if not full:
+            file_count += _cleanup_manifest_files(
+                context, index, manifest, dryrun, workers, throttle,
+                filepaths, errors)
+        if not dryrun:
+            manifest.save()
+    finally:
+        manifest.close()
+
+    _gauge_throttle(context, throttle)
+    return {
+        "file_count": file_count,
+        "filepaths": filepaths,
+        "errors": errors,
+    }
+
+
+def _cleanup_manifest_files(context, index, manifest, dryrun, workers,
+                            throttle, filepaths, errors):
+    """
+    removes the files of the manifest whose resource is no longer active
+    and returns their number: CKAN keeps the file of a deleted resource
+    and the mtime of its directory, so these orphans are found by
+    checking the manifest against the active resources, without walking
+    the filestore
+    """
+    with metrics.phase(context, 'select'):
+        resource_ids = _get_resource_ids()
+    orphans = OrderedDict()
+    for directory, filepath in manifest.iter_files():
+        if index.resource_id(filepath) not in resource_ids:
+            orphans.setdefault(directory, []).append(filepath)
+    all_orphans = [filepath for directory_orphans in orphans.values()
+                   for filepath in directory_orphans]
+    if dryrun or not all_orphans:
+        _add_files(context, filepaths, all_orphans, [], dryrun)
+        return len(all_orphans)
+
+    with metrics.phase(context, 'file_removal'):
+        failed = set(filestore.remove_files(all_orphans, workers, throttle))
+    metrics.count(context, 'files_removed', len(all_orphans) - len(failed))
+    _add_files(context, filepaths, all_orphans, failed, dryrun)
+    for filepath in sorted(failed):
+        _add_error(context, errors, {
+            'filepath': filepath,
+            'resource_id': index.resource_id(filepath),
+            'exception': 'could not be deleted',
+        })
+    # files that could not be removed stay in the manifest and are
+    # checked again on the next run
+    for directory, directory_orphans in orphans.items():
+        removed = [filepath for filepath in directory_orphans
+                   if filepath not in failed]
+        if removed:
+            manifest.remove_files(directory, removed, os.stat(
+                os.path.join(index.resource_path, directory)).st_mtime)
+    return len(all_orphans)
+
+
+@metrics.instrument('cleanup_package_extra')
 def cleanup_package_extra(context, data_dict):
     """
-    cleans up package_extra table for a given key
+    cleans up package_extra table for the given keys and for the keys
+    that match `key_pattern` (a SQL LIKE pattern): the extras are counted
+    per key with one query and deleted for all keys in one pass.
+    With a plan in the context the ids of the extras are added to the
+    plan instead of being deleted.
     """
-    dryrun = data_dict.get('dryrun')
-    key = data_dict.get('key')
+    deletion_plan = get_plan(context)
+    dryrun = data_dict.get('dryrun') or deletion_plan is not None
+    keys = data_dict.get('keys') or []
+    if isinstance(keys, string_types):
+        keys = keys.split(',')
+    if data_dict.get('key'):
+        keys = list(keys) + [data_dict['key']]
+    key_pattern = data_dict.get('key_pattern')
+    if not keys and not key_pattern:
+        raise ValidationError({'key': ['Missing value']})
     tk.check_access('package_delete', context, data_dict)
-    delete_package_extras = model.Session.query(model.PackageExtra) \
-        .filter(model.PackageExtra.key == key) \
-        .all()
-    delete_package_extra_ids = [extra.id for extra in delete_package_extras]
-    count = len(delete_package_extra_ids)
-
-    sql = '''begin;
-    delete from package_extra_revision
-    where continuity_id in ('{delete_id_values}');
-    delete from package_extra
-    where id in  ('{delete_id_values}');
-    commit;
-    '''.format(delete_id_values="','".join(delete_package_extra_ids))
 
-    if not dryrun:
-        model.Session.execute(sql)
+    where = 'key = any(cast(:keys as text[])) or key like :key_pattern'
+    params = {'keys': keys, 'key_pattern': key_pattern}
+    with metrics.phase(context, 'select'):
+        counts = OrderedDict(
+            (key, count) for key, count in model.Session.execute(sa.text(
+                'select key, count(*) from package_extra where {} '
+                'group by key order by key'.format(where)), params))
+    # keys without extras are listed as well, so that a misspelled key
+    # shows up in the counts
+    for key in keys:
+        if key not in counts:
+            counts[key] = 0
+    count = sum(counts.values())
+    for key, key_count in counts.items():
+        report.record(context, 'package_extra_key', key=key, count=key_count)
+
+    if deletion_plan is not None and count:
+        with metrics.phase(context, 'select'):
+            for ids in stream_ids(
+                    'select id from package_extra where {}'.format(where),
+                    **params):
+                deletion_plan.add_ids('package_extra', ids)
+
+    deleted_rows = {}
+    if not dryrun and count:
+        with metrics.phase(context, 'delete'):
+            deleted_rows = delete_selected(
+                'select id from package_extra where {}'.format(where),
+                params, PACKAGE_EXTRA_STEPS)
+        metrics.count_rows(context, deleted_rows)
         log.debug("{} package_extras have been deleted"
                   .format(count))
     return {
         "count_deleted": count,
+        "counts": counts,
+        "dryrun": dryrun,
+        "deleted_rows": deleted_rows,
+    }
+
+
+@metrics.instrument('ogdch_apply_cleanup_plan')
+def ogdch_apply_cleanup_plan(context, data_dict):
+    """
+    applies the deletion plan that a cleanup command has written to the
+    file `plan`: exactly the ids and files of the plan are deleted,
+    nothing is looked up again. Resources that are no longer deleted are
+    skipped together with their files. The harvest sources of the plan
+    are reindexed afterwards.
+    """
+    path = tk.get_or_bust(data_dict, 'plan')
+    try:
+        deletion_plan = Plan.load(path)
+    except PlanError as e:
+        raise ValidationError({'plan': [str(e)]})
+    if deletion_plan.command not in PLAN_ACCESS:
+        raise ValidationError({'plan': ['Unknown command {}'.format(
+            deletion_plan.command)]})
+    tk.check_access(PLAN_ACCESS[deletion_plan.command], context, data_dict)
+    workers = int(data_dict.get('workers', 1))
+    throttle = get_throttle(data_dict)
+    log.info('Applying the plan {} of {} created at {}: {}'.format(
+        path, deletion_plan.command, deletion_plan.created,
+        dict(deletion_plan.counts())))
+
+    with metrics.phase(context, 'delete'):
+        deleted_rows, skipped = deletion_plan.delete_rows(throttle)
+    metrics.count_rows(context, deleted_rows)
+    for table, ids in skipped.items():
+        metrics.count(context, 'skipped', len(ids), table=table)
+        for id in ids:
+            report.record(context, 'skipped', table=table, id=id)
+
+    # only files in the filestore are removed, whatever the plan says,
+    # and the files of skipped resources are kept
+    skipped_resource_ids = set(skipped.get('resource', ()))
+    filepaths = []
+    errors = []
+    if deletion_plan.files:
+        index = filestore.FilestoreIndex(storage_path)
+    for filepath in deletion_plan.files:
+        if not os.path.normpath(filepath).startswith(
+                index.resource_path + os.sep):
+            _add_error(context, errors, {'filepath': filepath,
+                                         'resource_id': None,
+                                         'exception': 'not in the filestore',
+                                         })
+        elif index.resource_id(filepath) in skipped_resource_ids:
+            report.record(context, 'skipped', table='file', path=filepath)
+        else:
+            filepaths.append(filepath)
+    with metrics.phase(context, 'file_removal'):
+        failed = filestore.remove_files(filepaths, workers, throttle)
+    metrics.count(context, 'files_removed', len(filepaths) - len(failed))
+    for filepath in failed:
+        _add_error(context, errors, {'filepath': filepath,
+                                     'resource_id': None,
+                                     'exception': 'could not be deleted',
+                                     })
+    if report.get_report(context) is not None:
+        _report_files(context, filepaths, failed, False)
+
+    reindex_queue = ReindexQueue()
+    for source_id in deletion_plan.sources:
+        reindex_queue.add_source(source_id)
+    with metrics.phase(context, 'reindex'):
+        reindex_queue.flush(
+            context, background=data_dict.get('enqueue_reindex', False))
+    _gauge_throttle(context, throttle)
+
+    return {
+        "command": deletion_plan.command,
+        "created": deletion_plan.created,
+        "deleted_rows": deleted_rows,
+        "skipped": OrderedDict(
+            (table, len(ids)) for table, ids in skipped.items()),
+        "file_count": len(filepaths) - len(failed),
+        "sources": deletion_plan.sources,
+        "errors": errors,
+    }
+
+
+@metrics.instrument('ogdch_cleanup_datastore')
+def ogdch_cleanup_datastore(context, data_dict):
+    """
+    cleans up the datastore tables of resources that are no longer
+    active: the table names are read page by page from the datastore,
+    every page is checked against the resource table with one query
+    and the orphaned tables of a page are dropped in one transaction,
+    as datastore_delete would do. Every table is dropped in a savepoint
+    of its own, so that a table that has gone in the meantime does not
+    fail the whole page.
+    """
+    dryrun = data_dict.get('dryrun')
+    page_size = int(data_dict.get('page_size', DATASTORE_PAGE_SIZE))
+    tk.check_access('datastore_delete', context, data_dict)
+    datastore_engine = get_write_engine()
+
+    count_tables = 0
+    count_deleted = 0
+    orphaned_tables = []
+    errors = []
+    for table_names in metrics.timed(
+            context, 'select',
+            _get_datastore_table_names(datastore_engine, page_size)):
+        count_tables += len(table_names)
+        with metrics.phase(context, 'select'):
+            orphaned_page = _get_orphaned_resource_ids(table_names)
+        failed = {}
+        if orphaned_page and not dryrun:
+            with metrics.phase(context, 'delete'):
+                failed = _drop_tables(datastore_engine, orphaned_page)
+            orphaned_page = [table_name for table_name in orphaned_page
+                             if table_name not in failed]
+            metrics.count(context, 'tables_dropped', len(orphaned_page))
+            metrics.count(context, 'errors', len(failed))
+            log.debug("{} datastore tables have been dropped"
+                      .format(len(orphaned_page)))
+        count_deleted += len(orphaned_page)
+        if report.get_report(context) is None:
+            orphaned_tables.extend(orphaned_page)
+        for table_name in orphaned_page:
+            report.record(context, 'datastore_table', name=table_name,
+                          dropped=not dryrun)
+        for table_name, error in failed.items():
+            if report.get_report(context) is None:
+                errors.append({'name': table_name, 'exception': error})
+            else:
+                report.record(context, 'error', name=table_name,
+                              exception=error)
+
+    return {
+        "count_tables": count_tables,
+        "count_deleted": count_deleted,
+        "tables": orphaned_tables,
+        "errors": errors,
         "dryrun": dryrun,
     }
 
 
+def _get_datastore_table_names(datastore_engine, page_size):
+    """
+    yields the names of the datastore tables page by page, aliases are
+    ignored
+    """
+    sql = sa.text('''select name from "_table_metadata"
+    where alias_of is null and name > :last_name
+    order by name limit :page_size''')
+    last_name = ''
+    while True:
+        table_names = [row[0] for row in datastore_engine.execute(
+            sql, last_name=last_name, page_size=page_size)]
+        if not table_names:
+            break
+        yield table_names
+        last_name = table_names[-1]
+
+
+def _get_orphaned_resource_ids(resource_ids):
+    """
+    returns the ids that do not belong to an active resource
+    """
+    sql = sa.text('''select ids.id from unnest(cast(:ids as text[])) as ids(id)
+    where not exists (
+        select 1 from resource r where r.id = ids.id and r.state = 'active')
+    order by ids.id''')
+    return [row[0] for row in model.Session.execute(
+        sql, {'ids': list(resource_ids)})]
+
+
+def _drop_tables(datastore_engine, table_names):
+    """
+    drops the tables together with their aliases in one transaction and
+    returns the errors of the tables that could not be dropped by name:
+    every table is dropped in a savepoint of its own
+    """
+    failed = {}
+    with datastore_engine.begin() as connection:
+        for table_name in table_names:
+            savepoint = connection.begin_nested()
+            try:
+                connection.execute('drop table if exists "{}" cascade'.format(
+                    table_name.replace('"', '""')))
+                savepoint.commit()
+            except sa.exc.SQLAlchemyError as e:
+                savepoint.rollback()
+                log.error('Datastore table {} could not be dropped: {}'
+                          .format(table_name, e))
+                failed[table_name] = str(e)
+    return failed
+
+
+@metrics.instrument('ogdch_cleanup_harvestsource')
 def ogdch_cleanup_harvestsource(context, data_dict):
     """
     cleaning up jobs for all harvest sources
@@ -300,37 +1040,53 @@ def ogdch_cleanup_harvestsource(context, data_dict):
         datetime.datetime.now() \
         - datetime.timedelta(timeframe_to_keep_harvested_datasets)
 
-    # gets all active harvest sources
-    harvest_sources = tk.get_action('harvest_source_list')(context, data_dict)
+    # selects the stale sources with one query
+    with metrics.phase(context, 'select'):
+        stale_sources = _get_stale_harvest_sources(
+            last_day_to_keep_harvested_ds)
     count_cleared_harvestsource = 0
-    if len(harvest_sources) != 0:
+    if len(stale_sources) != 0 and report.get_report(context) is None:
         print('Cleaning up harvester objects for all harvest sources')
 
-    for source in harvest_sources:
-        source_dict = tk.get_action('harvest_source_show')(context, {
-            'id': source['id']
-        })
-        # check if there are any harvest jobs
-        if not source_dict['status']['last_job']:
-            log.info('No jobs yet for this harvest source id={}'.format(
-                source['id']))
-        else:
-            last_job_creation_time = \
-                source_dict['status']['last_job']['created']
-            last_job_creation_time_obj = datetime.datetime.strptime(
-                last_job_creation_time, "%Y-%m-%d %H:%M:%S.%f")
-            last_job_age = (
-                    datetime.datetime.now() - last_job_creation_time_obj).days
-            last_job_status = source_dict['status']['last_job']['status']
-            log.info('The latest job of the harvester id={} is {} days old'
-                     .format(source['id'], last_job_age))
-
-            if (last_job_creation_time_obj < last_day_to_keep_harvested_ds
-                    and last_job_status == "Finished"):
-                count_cleared_harvestsource += 1
-                tk.get_action("harvest_source_clear")(context,
-                                                      {"id": source['id']})
+    # harvest_source_clear commits the index once per source: the
+    # commits are not deferred, since the action may run in a web process
+    # where deferring them would turn them off for every other request
+    with metrics.phase(context, 'delete'):
+        for source in stale_sources:
+            last_job_age = (datetime.datetime.now() - source.created).days
+            log.info('The latest job of the harvester id={} is {} days '
+                     'old'.format(source.source_id, last_job_age))
+            report.record(context, 'harvest_source',
+                          id=source.source_id,
+                          last_job_created=source.created)
+            count_cleared_harvestsource += 1
+            tk.get_action("harvest_source_clear")(
+                dict(context), {"id": source.source_id})
+
+    metrics.count(context, 'harvestsources_cleared',
+                  count_cleared_harvestsource)
 
     return {
             "count_cleared_harvestsource": count_cleared_harvestsource,
     }
+
+
+def _get_stale_harvest_sources(last_day_to_keep):
+    """
+    selects the active harvest sources whose last job is finished and
+    was created before the last day to keep: the last job of every source
+    is found with one query, jobs that have not been started yet are not
+    taken into account
+    """
+    sql = sa.text('''select last_job.source_id, last_job.created
+    from (
+        select distinct on (j.source_id) j.source_id, j.created, j.status
+        from harvest_job j
+        join harvest_source s on s.id = j.source_id
+        where s.active and j.status != 'New'
+        order by j.source_id, j.created desc
+    ) last_job
+    where last_job.status = 'Finished' and last_job.created < :last_day
+    order by last_job.source_id''')
+    return model.Session.execute(
+        sql, {'last_day': last_day_to_keep}).fetchall()
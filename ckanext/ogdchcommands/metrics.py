@@ -0,0 +1,234 @@
+# encoding: utf-8
+
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from ckan.common import config
+
+log = logging.getLogger(__name__)
+
+METRICS_KEY = 'ogdch_metrics'
+PREFIX = 'ogdch'
+
+
+class Metrics(object):
+    """
+    collects the durations of the phases and the counters of one run of
+    a command or an action and exports them to a Prometheus node exporter
+    textfile directory and/or a statsd daemon: the metrics may be recorded
+    by several threads, the durations of their phases add up
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.durations = OrderedDict()
+        self.counters = OrderedDict()
+        self.gauges = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                self.durations[phase] = \
+                    self.durations.get(phase, 0) + duration
+
+    def timed(self, phase, iterable):
+        """
+        yields the items of an iterable and records the time spent to
+        produce them as the phase, not the time spent on them
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, counter, value=1, **labels):
+        key = (counter, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, gauge, value, **labels):
+        with self._lock:
+            self.gauges[(gauge, tuple(sorted(labels.items())))] = value
+
+    def export(self, success=True):
+        """
+        exports the metrics to the configured targets: errors are only
+        logged, a failing export never fails the command or action
+        """
+        duration = time.time() - self.start
+        textfile_dir = config.get(
+            'ckanext.ogdchcommands.metrics.textfile_dir')
+        statsd_host = config.get('ckanext.ogdchcommands.metrics.statsd_host')
+        try:
+            if textfile_dir:
+                self._write_textfile(textfile_dir, duration, success)
+            if statsd_host:
+                self._send_statsd(
+                    statsd_host,
+                    int(config.get(
+                        'ckanext.ogdchcommands.metrics.statsd_port', 8125)),
+                    duration, success)
+        except Exception as e:
+            log.error('Exporting the metrics of {} failed: {}'
+                      .format(self.name, e))
+
+    def _write_textfile(self, textfile_dir, duration, success):
+        command = _label_value(self.name)
+        lines = [
+            '# TYPE {}_duration_seconds gauge'.format(PREFIX),
+            '{}_duration_seconds{{command="{}"}} {:.3f}'
+            .format(PREFIX, command, duration),
+            '# TYPE {}_success gauge'.format(PREFIX),
+            '{}_success{{command="{}"}} {}'
+            .format(PREFIX, command, int(success)),
+            '# TYPE {}_last_run_timestamp_seconds gauge'.format(PREFIX),
+            '{}_last_run_timestamp_seconds{{command="{}"}} {:.0f}'
+            .format(PREFIX, command, time.time()),
+        ]
+        if self.durations:
+            lines.append(
+                '# TYPE {}_phase_duration_seconds gauge'.format(PREFIX))
+        for phase, phase_duration in self.durations.items():
+            lines.append(
+                '{}_phase_duration_seconds{{command="{}",phase="{}"}} {:.3f}'
+                .format(PREFIX, command, _label_value(phase),
+                        phase_duration))
+        for metrics, suffix in ((self.counters, '_total'), (self.gauges, '')):
+            for (name, labels), value in metrics.items():
+                metric = '{}_{}{}'.format(PREFIX, _metric_name(name), suffix)
+                label_list = [('command', command)] + \
+                    [(_metric_name(k), _label_value(v)) for k, v in labels]
+                lines.append('{}{{{}}} {}'.format(
+                    metric,
+                    ','.join('{}="{}"'.format(k, v) for k, v in label_list),
+                    value))
+
+        # the node exporter must never read a partially written file
+        path = os.path.join(textfile_dir,
+                            '{}.prom'.format(_metric_name(self.name)))
+        fd, tmp_path = tempfile.mkstemp(dir=textfile_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+
+    def _send_statsd(self, host, port, duration, success):
+        name = '{}.{}'.format(PREFIX, _metric_name(self.name))
+        lines = ['{}.duration:{:.0f}|ms'.format(name, duration * 1000),
+                 '{}.success:{}|g'.format(name, int(success))]
+        for phase, phase_duration in self.durations.items():
+            lines.append('{}.phase.{}:{:.0f}|ms'.format(
+                name, _metric_name(phase), phase_duration * 1000))
+        for metrics, metric_type in ((self.counters, 'c'),
+                                     (self.gauges, 'g')):
+            for (metric, labels), value in metrics.items():
+                parts = [name, _metric_name(metric)] + \
+                    [_metric_name(v) for k, v in labels]
+                lines.append('{}:{}|{}'.format('.'.join(parts), value,
+                                               metric_type))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in lines:
+                sock.sendto(line.encode('utf-8'), (host, port))
+        finally:
+            sock.close()
+
+
+class _NoMetrics(object):
+    """
+    metrics that are not recorded: used outside of instrumented actions
+    """
+
+    @contextmanager
+    def phase(self, phase):
+        yield
+
+    def timed(self, phase, iterable):
+        return iterable
+
+    def count(self, counter, value=1, **labels):
+        pass
+
+    def gauge(self, gauge, value, **labels):
+        pass
+
+
+def instrument(name):
+    """
+    decorates an action so that its duration, phases and counters are
+    recorded in the context and exported when it is done
+    """
+    def decorator(action):
+        @wraps(action)
+        def wrapper(context, data_dict):
+            metrics = Metrics(name)
+            outer_metrics = context.get(METRICS_KEY)
+            context[METRICS_KEY] = metrics
+            success = False
+            try:
+                result = action(context, data_dict)
+                success = True
+                return result
+            finally:
+                if outer_metrics is None:
+                    context.pop(METRICS_KEY, None)
+                else:
+                    context[METRICS_KEY] = outer_metrics
+                metrics.export(success)
+        return wrapper
+    return decorator
+
+
+def get_metrics(context):
+    return context.get(METRICS_KEY) or _NoMetrics()
+
+
+def phase(context, name):
+    return get_metrics(context).phase(name)
+
+
+def timed(context, name, iterable):
+    return get_metrics(context).timed(name, iterable)
+
+
+def count(context, name, value=1, **labels):
+    get_metrics(context).count(name, value, **labels)
+
+
+def count_rows(context, deleted_rows):
+    """
+    counts the rows that were deleted per table
+    """
+    for table, rows in deleted_rows.items():
+        count(context, 'rows_deleted', rows, table=table)
+
+
+def gauge(context, name, value, **labels):
+    get_metrics(context).gauge(name, value, **labels)
+
+
+def _metric_name(value):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', str(value))
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
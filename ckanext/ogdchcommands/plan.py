@@ -0,0 +1,167 @@
+# encoding: utf-8
+
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from ckan import model
+
+from ckanext.ogdchcommands.db import batches
+from ckanext.ogdchcommands.deletion import (
+    add_counts, delete_ids,
+    HARVEST_JOB_STEPS, RESOURCE_STEPS, PACKAGE_EXTRA_STEPS,
+    HARVEST_OBJECT_ERROR_STEPS, HARVEST_OBJECT_EXTRA_STEPS,
+    HARVEST_OBJECT_STEPS)
+
+log = logging.getLogger(__name__)
+
+PLAN_KEY = 'ogdch_plan'
+PLAN_VERSION = 1
+
+# the ids of a plan are deleted with the steps of their table, in
+# batches of ids: a harvest job comes with all of its objects. The
+# tables are deleted in the order in which they have been planned.
+STEP_SETS = {
+    'harvest_job': (HARVEST_JOB_STEPS, 100),
+    'resource': (RESOURCE_STEPS, 10000),
+    'package_extra': (PACKAGE_EXTRA_STEPS, 10000),
+    'harvest_object_error': (HARVEST_OBJECT_ERROR_STEPS, 10000),
+    'harvest_object_extra': (HARVEST_OBJECT_EXTRA_STEPS, 10000),
+    'harvest_object': (HARVEST_OBJECT_STEPS, 10000),
+}
+
+# the ids that still have to be deleted when a plan is applied: rows
+# that have changed since the plan was written are skipped
+QUALIFYING_IDS = {
+    'resource': '''select id from resource
+        where id = any(cast(:ids as text[])) and state = 'deleted' ''',
+}
+
+
+class PlanError(Exception):
+    pass
+
+
+class Plan(object):
+    """
+    a deletion plan of a cleanup command: the ids to delete per table,
+    the files to remove and the harvest sources to reindex afterwards.
+    The plan is discovered by a dry run and saved as a gzipped JSON file
+    with a checksum, applying it later deletes exactly what is in it.
+    Ids and files may be added by several threads.
+    """
+
+    def __init__(self, command, ids=None, files=None, sources=None,
+                 created=None):
+        self.command = command
+        self.ids = OrderedDict(ids or ())
+        self.files = list(files or ())
+        self.sources = list(sources or ())
+        self.created = created or datetime.datetime.utcnow().isoformat()
+        self._lock = threading.Lock()
+
+    def add_ids(self, table, ids):
+        if table not in STEP_SETS:
+            raise PlanError('Rows of {} cannot be deleted by a plan'
+                            .format(table))
+        with self._lock:
+            self.ids.setdefault(table, []).extend(ids)
+
+    def add_files(self, filepaths):
+        with self._lock:
+            self.files.extend(filepaths)
+
+    def add_source(self, source_id):
+        with self._lock:
+            self.sources.append(source_id)
+
+    def counts(self):
+        counts = OrderedDict(
+            (table, len(ids)) for table, ids in self.ids.items())
+        counts['files'] = len(self.files)
+        return counts
+
+    def save(self, path):
+        payload = self._payload()
+        document = {'checksum': _checksum(payload), 'plan': payload}
+        with gzip.open(path, 'wb') as plan_file:
+            plan_file.write(json.dumps(document).encode('utf-8'))
+        log.info('Plan of {} saved to {}: {}'
+                 .format(self.command, path, dict(self.counts())))
+
+    @classmethod
+    def load(cls, path):
+        """
+        loads a plan and verifies its checksum and its version
+        """
+        try:
+            with gzip.open(path, 'rb') as plan_file:
+                document = json.loads(plan_file.read().decode('utf-8'),
+                                      object_pairs_hook=OrderedDict)
+            payload = document['plan']
+        except (IOError, ValueError, KeyError) as e:
+            raise PlanError('The plan {} cannot be read: {}'.format(path, e))
+        if _checksum(payload) != document.get('checksum'):
+            raise PlanError('The checksum of the plan {} does not match'
+                            .format(path))
+        if payload.get('version') != PLAN_VERSION:
+            raise PlanError('The plan {} has the unsupported version {}'
+                            .format(path, payload.get('version')))
+        unknown_tables = set(payload['ids']) - set(STEP_SETS)
+        if unknown_tables:
+            raise PlanError('The plan {} deletes rows of unknown tables: {}'
+                            .format(path, ', '.join(sorted(unknown_tables))))
+        return cls(payload['command'], payload['ids'], payload['files'],
+                   payload['sources'], payload['created'])
+
+    def _payload(self):
+        return OrderedDict([
+            ('version', PLAN_VERSION),
+            ('command', self.command),
+            ('created', self.created),
+            ('ids', self.ids),
+            ('files', self.files),
+            ('sources', self.sources),
+        ])
+
+    def delete_rows(self, throttle=None):
+        """
+        deletes the ids of every table with the steps of the table and
+        returns the number of deleted rows per table and the ids that
+        have been skipped per table, because they no longer qualify for
+        deletion
+        """
+        deleted_rows = OrderedDict()
+        skipped = OrderedDict()
+        for table, ids in self.ids.items():
+            steps, batch_size = STEP_SETS[table]
+            for batch in batches(ids, batch_size):
+                if table in QUALIFYING_IDS:
+                    qualifying = set(row[0] for row in model.Session.execute(
+                        sa.text(QUALIFYING_IDS[table]), {'ids': batch}))
+                    skipped_ids = [id for id in batch if id not in qualifying]
+                    if skipped_ids:
+                        log.info('{} ids of {} are skipped: they no longer '
+                                 'qualify for deletion'
+                                 .format(len(skipped_ids), table))
+                        skipped.setdefault(table, []).extend(skipped_ids)
+                        batch = [id for id in batch if id in qualifying]
+                    if not batch:
+                        continue
+                add_counts(deleted_rows,
+                           delete_ids(batch, steps, throttle=throttle))
+        return deleted_rows, skipped
+
+
+def get_plan(context):
+    return context.get(PLAN_KEY)
+
+
+def _checksum(payload):
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
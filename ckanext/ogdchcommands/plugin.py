@@ -27,10 +27,13 @@ class OgdchCommandsPlugin(plugins.SingletonPlugin):
         '''
         return {
             'ogdch_cleanup_harvestjobs': l.ogdch_cleanup_harvestjobs,
+            'ogdch_cleanup_harvestobjects': l.ogdch_cleanup_harvestobjects,
             'ogdch_cleanup_resources': l.ogdch_cleanup_resources,
             'ogdch_cleanup_filestore': l.ogdch_cleanup_filestore,
             'cleanup_package_extra': l.cleanup_package_extra,
             'ogdch_cleanup_harvestsource': l.ogdch_cleanup_harvestsource,
+            'ogdch_cleanup_datastore': l.ogdch_cleanup_datastore,
+            'ogdch_apply_cleanup_plan': l.ogdch_apply_cleanup_plan,
         }
 
 
@@ -51,4 +54,5 @@ class OgdchAdminPlugin(plugins.SingletonPlugin):
             'ogdch_check_indexing': admin.ogdch_check_indexing,
             'ogdch_check_field': admin.ogdch_check_field,
             'ogdch_latest_dataset_activities': admin.ogdch_latest_dataset_activities, # noqa
+            'ogdch_job_status': admin.ogdch_job_status,
         }
@@ -0,0 +1,201 @@
+# encoding: utf-8
+
+import logging
+import threading
+import time
+from multiprocessing import Pool
+
+from ckan import model
+from ckan.lib.search import commit, index_for
+from ckan.lib.search.common import make_connection
+import ckan.plugins.toolkit as tk
+
+from ckanext.ogdchcommands.db import batches, stream_ids
+from ckanext.ogdchcommands.search import (
+    iter_index_differences, iter_indexed_package_ids, iter_package_ids,
+    merge_differences, site_filter)
+
+log = logging.getLogger(__name__)
+
+REINDEX_BATCH_SIZE = 100
+
+
+def get_package_ids(package_id=None, only_missing=False):
+    """
+    returns the ids of the packages to index: a single package, the
+    packages that are missing in the index or all packages that are
+    not deleted
+    """
+    if package_id:
+        package = model.Package.get(package_id)
+        if not package:
+            raise tk.ObjectNotFound(
+                'Package {} does not exist'.format(package_id))
+        return [package.id]
+    if only_missing:
+        return [db_id for db_id, index_id in iter_index_differences()
+                if db_id]
+    package_ids = []
+    for ids in stream_ids('select id from package where state != :state',
+                          state='deleted'):
+        package_ids.extend(ids)
+    return package_ids
+
+
+def reindex_packages(package_ids, workers=1,
+                     batch_size=REINDEX_BATCH_SIZE, progress=None):
+    """
+    indexes the packages batch by batch, with a pool of worker processes
+    if there is more than one worker: the commits to the index are
+    deferred and done once at the end. The throughput and the failures
+    per package are returned. `progress` is called with the number of
+    packages done and the total after every batch.
+    """
+    start = time.time()
+    package_batches = list(batches(package_ids, batch_size))
+    indexed = 0
+    failed = {}
+    for batch_indexed, batch_failed in _map_batches(package_batches,
+                                                    workers):
+        indexed += batch_indexed
+        failed.update(batch_failed)
+        if progress:
+            progress(indexed + len(failed), len(package_ids))
+    commit()
+    duration = time.time() - start
+    log.info('{} packages indexed in {:.1f}s, {} failed'
+             .format(indexed, duration, len(failed)))
+    return {
+        'indexed': indexed,
+        'count_failed': len(failed),
+        'failed': failed,
+        'duration': round(duration, 2),
+        'packages_per_second':
+            round(indexed / duration, 2) if duration else indexed,
+    }
+
+
+def remove_stale_entries(batch_size=REINDEX_BATCH_SIZE):
+    """
+    removes the index entries of packages that are deleted or no longer
+    exist, in batches with one commit of the index at the end, and
+    returns their number: a full reindex does not clear the index
+    beforehand, so these entries would stay forever
+    """
+    conn = make_connection()
+    stale_ids = (index_id for db_id, index_id in merge_differences(
+        iter_package_ids(batch_size, active_only=False),
+        iter_indexed_package_ids(batch_size, active_only=False))
+        if index_id)
+    removed = 0
+    for batch in batches(stale_ids, batch_size):
+        # the removals only become visible with the commit, so they do
+        # not affect the cursor over the index
+        conn.delete(q='{} +id:({})'.format(
+            site_filter(), ' OR '.join('"{}"'.format(id) for id in batch)),
+            commit=False)
+        removed += len(batch)
+    if removed:
+        commit()
+    log.info('{} stale index entries removed'.format(removed))
+    return removed
+
+
+class ReindexQueue(object):
+    """
+    collects the harvest sources that have to be reindexed during a
+    cleanup run without duplicates: they are reindexed in one pass with
+    a single commit of the index at the end of the run, or by a
+    background job. Sources may be added by several threads.
+    """
+
+    def __init__(self):
+        self.source_ids = set()
+        self._lock = threading.Lock()
+
+    def add_source(self, source_id):
+        with self._lock:
+            self.source_ids.add(source_id)
+
+    def flush(self, context, background=False):
+        """
+        reindexes the queued sources, or enqueues a background job that
+        does so, and empties the queue: the ids of the sources that have
+        been flushed are returned
+        """
+        with self._lock:
+            source_ids = sorted(self.source_ids)
+            self.source_ids = set()
+        if not source_ids:
+            return []
+        if background:
+            tk.enqueue_job(reindex_queued, [source_ids],
+                           title='ogdch reindex after cleanup')
+            log.info('Reindexing of {} sources enqueued'
+                     .format(len(source_ids)))
+        else:
+            reindex_queued(source_ids, context)
+        return source_ids
+
+
+def reindex_queued(source_ids, context=None):
+    """
+    reindexes harvest sources with a single commit of the index: this is
+    also the function of the background job
+    """
+    if context is None:
+        site_user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
+        context = {'model': model,
+                   'session': model.Session,
+                   'ignore_auth': True,
+                   'user': site_user['name']}
+    source_context = dict(context, defer_commit=True)
+    for source_id in source_ids:
+        tk.get_action('harvest_source_reindex')(
+            dict(source_context), {'id': source_id})
+    commit()
+    log.info('{} sources reindexed'.format(len(source_ids)))
+
+
+def _map_batches(package_batches, workers):
+    if workers <= 1 or len(package_batches) <= 1:
+        for batch in package_batches:
+            yield _index_batch(batch)
+        return
+
+    # the worker processes must not share the database connections
+    # of this process: they open their own after the fork
+    model.Session.remove()
+    model.meta.engine.dispose()
+    pool = Pool(min(workers, len(package_batches)))
+    try:
+        for result in pool.imap_unordered(_index_batch, package_batches):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _index_batch(package_ids):
+    """
+    indexes a batch of packages without committing the index and returns
+    the number of indexed packages and the failures per package
+    """
+    package_index = index_for(model.Package)
+    context = {'model': model,
+               'ignore_auth': True,
+               'validate': False,
+               'use_cache': False}
+    indexed = 0
+    failed = {}
+    for package_id in package_ids:
+        try:
+            pkg_dict = tk.get_action('package_show')(
+                dict(context), {'id': package_id})
+            package_index.update_dict(pkg_dict, defer_commit=True)
+            indexed += 1
+        except Exception as e:
+            log.error('Indexing package {} failed: {}'
+                      .format(package_id, e))
+            failed[package_id] = str(e)
+    return indexed, failed
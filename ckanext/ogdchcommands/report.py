@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+import datetime
+import json
+import sys
+import threading
+
+REPORT_KEY = 'ogdch_report'
+
+
+class NdjsonReport(object):
+    """
+    streams the records of a run as newline delimited JSON to a file or
+    to stdout: every record is written and flushed as soon as it is
+    reported, nothing is kept in memory. Records may be reported by
+    several threads.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.output = open(path, 'w') if path else sys.stdout
+        self._lock = threading.Lock()
+
+    def record(self, record_type, **fields):
+        fields['type'] = record_type
+        line = json.dumps(fields, sort_keys=True, default=_to_json)
+        with self._lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def summary(self, **fields):
+        self.record('summary', **fields)
+
+    def close(self):
+        if self.path:
+            self.output.close()
+
+
+def open_report(spec):
+    """
+    opens the report of a `--report` option: `ndjson` streams the records
+    to stdout, `ndjson:<path>` to a file
+    """
+    report_format, _, path = spec.partition(':')
+    if report_format != 'ndjson':
+        raise ValueError('Unknown report format {}, only ndjson is supported'
+                         .format(report_format))
+    return NdjsonReport(path or None)
+
+
+def get_report(context):
+    return context.get(REPORT_KEY)
+
+
+def record(context, record_type, **fields):
+    """
+    reports a record if the context has a report
+    """
+    report = get_report(context)
+    if report is not None:
+        report.record(record_type, **fields)
+
+
+def _to_json(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
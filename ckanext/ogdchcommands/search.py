@@ -0,0 +1,152 @@
+# encoding: utf-8
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from ckan.common import config
+from ckan.lib.search import commit
+from ckan.lib.search.common import make_connection
+
+from ckanext.ogdchcommands.db import stream_ids
+
+log = logging.getLogger(__name__)
+
+SOLR_PAGE_SIZE = 1000
+
+
+def site_filter():
+    return '+site_id:"{}"'.format(config.get('ckan.site_id'))
+
+
+def iter_solr_docs(fq, fl, sort='index_id asc', rows=SOLR_PAGE_SIZE,
+                   q='*:*'):
+    """
+    yields the documents of a Solr query with cursorMark paging, so that
+    the cost of a page does not grow with its offset: the sort has to
+    end on the unique key of the index (index_id)
+    """
+    conn = make_connection()
+    cursor_mark = '*'
+    while True:
+        result = conn.search(q=q, fq=fq, fl=fl, sort=sort, rows=rows,
+                             cursorMark=cursor_mark)
+        for doc in result.docs:
+            yield doc
+        next_cursor_mark = result.nextCursorMark
+        if not result.docs or next_cursor_mark == cursor_mark:
+            break
+        cursor_mark = next_cursor_mark
+
+
+def iter_indexed_package_ids(rows=SOLR_PAGE_SIZE, active_only=True):
+    """
+    yields the ids of the active packages in the index, or of all of its
+    packages, in ascending order: drafts are indexed as well
+    """
+    fq = [site_filter()]
+    if active_only:
+        fq.append('+state:active')
+    for doc in iter_solr_docs(fq=fq, fl='id', sort='id asc, index_id asc',
+                              rows=rows):
+        yield doc['id']
+
+
+def iter_package_ids(rows=SOLR_PAGE_SIZE, active_only=True):
+    """
+    yields the ids of the active packages in the database, or of all
+    packages that are not deleted, in ascending order: the byte order of
+    the "C" collation is the order of Solr
+    """
+    where = 'state = :state' if active_only else 'state != :state'
+    for ids in stream_ids(
+            'select id from package where {} order by id collate "C"'
+            .format(where), batch_size=rows,
+            state='active' if active_only else 'deleted'):
+        for id in ids:
+            yield id
+
+
+def iter_index_differences(rows=SOLR_PAGE_SIZE, progress=None):
+    """
+    merges the sorted package ids of the database and of the index and
+    yields the differences as tuples: (id, None) for a package that is
+    not indexed and (None, id) for an index entry without a package.
+    `progress` is called with the number of ids merged so far after
+    every `rows` ids and at the end.
+    """
+    return merge_differences(iter_package_ids(rows),
+                             iter_indexed_package_ids(rows),
+                             progress, rows)
+
+
+def merge_differences(db_ids, index_ids, progress=None, interval=1):
+    """
+    merges two iterables of ascending ids and yields the differences
+    """
+    end = object()
+    merged = 0
+    db_id = next(db_ids, end)
+    index_id = next(index_ids, end)
+    while db_id is not end or index_id is not end:
+        if index_id is end or (db_id is not end and db_id < index_id):
+            yield db_id, None
+            db_id = next(db_ids, end)
+        elif db_id is end or index_id < db_id:
+            yield None, index_id
+            index_id = next(index_ids, end)
+        else:
+            db_id = next(db_ids, end)
+            index_id = next(index_ids, end)
+        merged += 1
+        if progress and merged % interval == 0:
+            progress(merged)
+    if progress:
+        progress(merged)
+
+
+class _CommitDeferral(object):
+    """
+    turns the commits of the index off while at least one block defers
+    them: nested and concurrent blocks share the deferral, the setting is
+    restored when the last one ends
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.solr_commit = None
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            if not self.depth:
+                self.solr_commit = config.get('ckan.search.solr_commit',
+                                              'true')
+                config['ckan.search.solr_commit'] = 'false'
+            self.depth += 1
+
+    def exit(self):
+        with self._lock:
+            self.depth -= 1
+            if not self.depth:
+                config['ckan.search.solr_commit'] = self.solr_commit
+
+
+_deferral = _CommitDeferral()
+
+
+@contextmanager
+def deferred_commits():
+    """
+    defers the commits of the search index for all packages that are
+    indexed within the block: the index is committed at the end. The
+    setting is global to the process, so this is only meant for the
+    commands: in a web process the requests would lose their commits
+    while a block is running.
+    """
+    _deferral.enter()
+    try:
+        yield
+    finally:
+        _deferral.exit()
+        commit()
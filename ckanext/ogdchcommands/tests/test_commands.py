@@ -0,0 +1,25 @@
+# encoding: utf-8
+
+import unittest
+from datetime import date
+
+from ckanext.ogdchcommands.commands import (
+    is_due_to_be_published, parse_scheduled)
+
+
+class TestScheduled(unittest.TestCase):
+
+    def test_parse_scheduled(self):
+        self.assertEqual(parse_scheduled('17.10.2026'), date(2026, 10, 17))
+        self.assertEqual(parse_scheduled('2026-10-17T00:00:00Z'),
+                         date(2026, 10, 17))
+        self.assertIsNone(parse_scheduled(''))
+        self.assertIsNone(parse_scheduled(None))
+        self.assertIsNone(parse_scheduled('next week'))
+
+    def test_is_due_to_be_published(self):
+        today = date(2026, 10, 17)
+        self.assertTrue(is_due_to_be_published('16.10.2026', today))
+        self.assertTrue(is_due_to_be_published('17.10.2026', today))
+        self.assertFalse(is_due_to_be_published('18.10.2026', today))
+        self.assertFalse(is_due_to_be_published(None, today))
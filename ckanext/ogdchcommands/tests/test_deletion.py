@@ -0,0 +1,83 @@
+# encoding: utf-8
+
+import unittest
+
+from ckanext.ogdchcommands.deletion import (
+    _copy_buffer, _copy_escape, _delete)
+from ckanext.ogdchcommands.throttle import Throttle, MIN_BACKOFF
+
+
+class TestCopyBuffer(unittest.TestCase):
+
+    def test_one_id_per_line(self):
+        data = _copy_buffer([u'a', u'b', u'c']).read()
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        self.assertEqual(data, u'a\nb\nc\n')
+
+    def test_special_characters_are_escaped(self):
+        self.assertEqual(_copy_escape(u'a\\b\tc\nd\re'),
+                         u'a\\\\b\\tc\\nd\\re')
+
+    def test_empty(self):
+        self.assertFalse(_copy_buffer([]).read())
+
+
+class Result(object):
+    rowcount = 2
+
+
+class Session(object):
+
+    def __init__(self, calls, fail=None):
+        self.calls = calls
+        self.fail = fail
+
+    def execute(self, sql):
+        self.calls.append('execute')
+        if sql == self.fail:
+            raise RuntimeError(sql)
+        return Result()
+
+    def commit(self):
+        self.calls.append('commit')
+
+    def rollback(self):
+        self.calls.append('rollback')
+
+
+class RecordingThrottle(Throttle):
+
+    def __init__(self, calls):
+        super(RecordingThrottle, self).__init__(latency_threshold=0.5,
+                                                chunk_size=10)
+        self.calls = calls
+
+    def back_off(self, seconds):
+        self.calls.append(('back_off', seconds))
+
+
+class TestDelete(unittest.TestCase):
+
+    steps = [('a', 'delete from a'), ('b', 'delete from b')]
+
+    def _throttle(self, calls):
+        throttle = RecordingThrottle(calls)
+        # every statement is slower than the threshold
+        throttle.observe = lambda latency: Throttle.observe(throttle, 1)
+        return throttle
+
+    def test_back_off_after_the_commit(self):
+        calls = []
+        deleted = _delete(Session(calls), self.steps, lambda session: 0,
+                          self._throttle(calls))
+        self.assertEqual(dict(deleted), {'a': 2, 'b': 2})
+        self.assertEqual(calls[-2:],
+                         ['commit', ('back_off', MIN_BACKOFF * 3)])
+
+    def test_back_off_after_the_rollback(self):
+        calls = []
+        session = Session(calls, fail='delete from b')
+        self.assertRaises(RuntimeError, _delete, session, self.steps,
+                          lambda session: 0, self._throttle(calls))
+        self.assertEqual(calls[-2:], ['rollback', ('back_off', MIN_BACKOFF)])
@@ -0,0 +1,132 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ckanext.ogdchcommands import filestore
+
+IDS = [
+    '0b7a8c34-1efd-474c-a347-6b2690e6344b',
+    '5f2e4d11-0c3b-4a8e-9d6f-2b1c0e9a7d35',
+    'bfbf4c75-1efd-474c-a347-6b2690e6344b',
+]
+
+
+class TestResourceIdSet(unittest.TestCase):
+
+    def test_contains_ids_in_order(self):
+        ids = filestore.ResourceIdSet(IDS)
+        for id in IDS:
+            self.assertIn(id, ids)
+        self.assertNotIn('ffffffff-1efd-474c-a347-6b2690e6344b', ids)
+        self.assertEqual(len(ids), 3)
+
+    def test_contains_ids_out_of_order(self):
+        ids = filestore.ResourceIdSet(reversed(IDS))
+        for id in IDS:
+            self.assertIn(id, ids)
+        self.assertNotIn('00000000-1efd-474c-a347-6b2690e6344b', ids)
+
+    def test_other_ids_are_kept_as_strings(self):
+        # only the canonical form of a UUID goes into the byte array
+        upper = IDS[0].upper()
+        ids = filestore.ResourceIdSet([IDS[0], 'not-a-uuid', upper])
+        self.assertIn('not-a-uuid', ids)
+        self.assertIn(upper, ids)
+        self.assertIn(IDS[0], ids)
+        self.assertNotIn(IDS[1].upper(), ids)
+        self.assertEqual(len(ids), 3)
+
+    def test_empty(self):
+        ids = filestore.ResourceIdSet([])
+        self.assertNotIn(IDS[0], ids)
+        self.assertEqual(len(ids), 0)
+
+
+class TestFilestoreIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = filestore.FilestoreIndex('/srv/storage')
+
+    def test_path_and_resource_id_are_inverse(self):
+        path = self.index.path(IDS[2])
+        self.assertEqual(path, os.path.join(
+            self.index.resource_path, 'bfb', 'f4c',
+            '75-1efd-474c-a347-6b2690e6344b'))
+        self.assertEqual(self.index.resource_id(path), IDS[2])
+
+    def test_unsafe_ids_are_rejected(self):
+        for id in ['', '../../../etc/passwd', '.hidden']:
+            self.assertRaises(ValueError, self.index.path, id)
+
+    def test_storage_path_is_required(self):
+        self.assertRaises(TypeError, filestore.FilestoreIndex, None)
+
+
+class TestScan(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.resource_path = os.path.join(self.directory, 'resources')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _create(self, *paths):
+        for path in paths:
+            filepath = os.path.join(self.resource_path, path)
+            if not os.path.isdir(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            open(filepath, 'w').close()
+        return [os.path.join(self.resource_path, path) for path in paths]
+
+    def test_files_per_bucket(self):
+        root, first, second, third = self._create(
+            'stray', 'abc/def/1', 'abc/def/2', 'ghi/jkl/3')
+        for workers in (1, 4):
+            self.assertEqual(list(filestore.scan(self.resource_path,
+                                                 workers)),
+                             [[root], [first, second], [third]])
+
+    def test_directories(self):
+        self._create('abc/def/1')
+        self.assertEqual(
+            sorted(filestore.list_directories(self.resource_path)),
+            ['', 'abc', os.path.join('abc', 'def')])
+
+    def test_missing_filestore(self):
+        self.assertEqual(list(filestore.scan(self.resource_path)), [])
+        self.assertEqual(filestore.list_directories(self.resource_path), {})
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.resource_path = os.path.join(self.directory, 'resources')
+        self.manifest = filestore.Manifest(
+            os.path.join(self.directory, 'manifest.sqlite'),
+            self.resource_path)
+        self.files = [os.path.join(self.resource_path, 'abc', 'def', name)
+                      for name in ('1', '2', '3')]
+        self.manifest.update_directory(os.path.join('abc', 'def'), 1.0,
+                                       self.files)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.directory)
+
+    def test_iter_files(self):
+        self.assertEqual(
+            list(self.manifest.iter_files()),
+            [(os.path.join('abc', 'def'), filepath)
+             for filepath in self.files])
+
+    def test_remove_files(self):
+        directory = os.path.join('abc', 'def')
+        self.manifest.remove_files(directory, self.files[:2], 2.0)
+        self.assertEqual(self.manifest.files(directory),
+                         set(self.files[2:]))
+        self.assertEqual(self.manifest.directory_mtimes(), {directory: 2.0})
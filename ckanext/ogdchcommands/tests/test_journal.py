@@ -0,0 +1,58 @@
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ckanext.ogdchcommands.journal import Journal
+
+CONFIGURATION = {'number_of_jobs_to_keep': 10, 'harvest_source_id': None}
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write_journal(self):
+        journal = Journal(self.path, CONFIGURATION)
+        journal.update('source-1', Journal.DELETING, 3)
+        journal.update('source-1', Journal.DELETING, 2)
+        journal.update('source-2', Journal.DONE)
+        return journal
+
+    def test_resume_reads_the_states(self):
+        self._write_journal()
+        journal = Journal(self.path, CONFIGURATION, resume=True)
+        self.assertEqual(journal.state('source-1'), Journal.DELETING)
+        self.assertEqual(journal.sources['source-1']['deleted_jobs'], 5)
+        self.assertEqual(journal.state('source-2'), Journal.DONE)
+        self.assertIsNone(journal.state('source-3'))
+
+    def test_other_configuration_starts_over(self):
+        self._write_journal()
+        journal = Journal(self.path, dict(CONFIGURATION,
+                                          number_of_jobs_to_keep=2),
+                          resume=True)
+        self.assertIsNone(journal.state('source-1'))
+
+    def test_without_resume_the_journal_is_removed(self):
+        self._write_journal()
+        journal = Journal(self.path, CONFIGURATION)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(journal.state('source-2'))
+
+    def test_unreadable_journal_starts_over(self):
+        with open(self.path, 'w') as journal_file:
+            journal_file.write('{"configuration": ')
+        journal = Journal(self.path, CONFIGURATION, resume=True)
+        self.assertEqual(journal.sources, {})
+
+    def test_save_leaves_no_temporary_files(self):
+        self._write_journal()
+        self.assertEqual(os.listdir(self.directory), ['journal.json'])
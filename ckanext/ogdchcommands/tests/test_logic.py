@@ -0,0 +1,57 @@
+# encoding: utf-8
+
+import unittest
+from collections import namedtuple
+
+from ckanext.ogdchcommands import logic
+from ckanext.ogdchcommands.logic import _chunk_jobs, _get_journal_path
+
+Job = namedtuple('Job', ['id', 'nr_objects'])
+
+
+class TestChunkJobs(unittest.TestCase):
+
+    def _chunk(self, nr_objects, max_objects):
+        jobs = [Job(i, n) for i, n in enumerate(nr_objects)]
+        return [[job.id for job in chunk]
+                for chunk in _chunk_jobs(jobs, max_objects)]
+
+    def test_jobs_are_chunked_by_objects(self):
+        self.assertEqual(self._chunk([3, 4, 2, 5, 1], 7),
+                         [[0, 1], [2, 3], [4]])
+
+    def test_large_job_is_a_chunk_of_its_own(self):
+        self.assertEqual(self._chunk([1, 20, 1], 5), [[0], [1], [2]])
+
+    def test_jobs_without_objects(self):
+        self.assertEqual(self._chunk([0, 0, 0], 5), [[0, 1, 2]])
+        self.assertEqual(self._chunk([], 5), [])
+
+
+class TestGetJournalPath(unittest.TestCase):
+
+    def setUp(self):
+        self.config, self.storage_path = logic.config, logic.storage_path
+        logic.config = {}
+        logic.storage_path = None
+
+    def tearDown(self):
+        logic.config, logic.storage_path = self.config, self.storage_path
+
+    def test_configured_path(self):
+        logic.config = {
+            'ckanext.ogdchcommands.harvestjobs_journal': '/tmp/journal'}
+        logic.storage_path = '/srv/storage'
+        self.assertEqual(_get_journal_path(), '/tmp/journal')
+
+    def test_path_in_the_storage(self):
+        logic.storage_path = '/srv/storage'
+        self.assertEqual(_get_journal_path(required=True),
+                         '/srv/storage/' + logic.HARVESTJOBS_JOURNAL)
+
+    def test_no_journal_without_a_path(self):
+        self.assertIsNone(_get_journal_path())
+
+    def test_required_journal_without_a_path(self):
+        self.assertRaises(logic.ValidationError, _get_journal_path,
+                          required=True)
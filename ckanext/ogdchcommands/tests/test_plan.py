@@ -0,0 +1,122 @@
+# encoding: utf-8
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ckanext.ogdchcommands import plan as plan_module
+from ckanext.ogdchcommands.plan import Plan, PlanError, PLAN_VERSION, _checksum
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'plan.json.gz')
+        self.plan = Plan('cleanup_resources')
+        self.plan.add_ids('resource', ['resource-1', 'resource-2'])
+        self.plan.add_ids('package_extra', ['extra-1'])
+        self.plan.add_files(['/srv/storage/resources/abc/def/ghi'])
+        self.plan.add_source('source-1')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _rewrite(self, change, checksum=True):
+        with gzip.open(self.path, 'rb') as plan_file:
+            document = json.loads(plan_file.read().decode('utf-8'))
+        change(document['plan'])
+        if checksum:
+            document['checksum'] = _checksum(document['plan'])
+        with gzip.open(self.path, 'wb') as plan_file:
+            plan_file.write(json.dumps(document).encode('utf-8'))
+
+    def test_save_and_load(self):
+        self.plan.save(self.path)
+        plan = Plan.load(self.path)
+        self.assertEqual(plan.command, 'cleanup_resources')
+        self.assertEqual(list(plan.ids), ['resource', 'package_extra'])
+        self.assertEqual(plan.ids['resource'], ['resource-1', 'resource-2'])
+        self.assertEqual(plan.files, self.plan.files)
+        self.assertEqual(plan.sources, ['source-1'])
+        self.assertEqual(plan.created, self.plan.created)
+        self.assertEqual(dict(plan.counts()),
+                         {'resource': 2, 'package_extra': 1, 'files': 1})
+
+    def test_tampered_plan_is_rejected(self):
+        self.plan.save(self.path)
+        self._rewrite(lambda payload: payload['ids']['resource'].append(
+            'resource-3'), checksum=False)
+        self.assertRaises(PlanError, Plan.load, self.path)
+
+    def test_other_version_is_rejected(self):
+        self.plan.save(self.path)
+        self._rewrite(
+            lambda payload: payload.update(version=PLAN_VERSION + 1))
+        self.assertRaises(PlanError, Plan.load, self.path)
+
+    def test_unknown_tables_are_rejected(self):
+        self.plan.save(self.path)
+        self._rewrite(
+            lambda payload: payload['ids'].update(package=['package-1']))
+        self.assertRaises(PlanError, Plan.load, self.path)
+
+    def test_unreadable_plan_is_rejected(self):
+        with open(self.path, 'wb') as plan_file:
+            plan_file.write(b'not a plan')
+        self.assertRaises(PlanError, Plan.load, self.path)
+        self.assertRaises(PlanError, Plan.load,
+                          os.path.join(self.directory, 'missing.json.gz'))
+
+    def test_unknown_table_cannot_be_added(self):
+        self.assertRaises(PlanError, self.plan.add_ids, 'package', ['id'])
+
+
+class Session(object):
+
+    def __init__(self, qualifying):
+        self.qualifying = qualifying
+
+    def execute(self, sql, params):
+        return [(id,) for id in params['ids'] if id in self.qualifying]
+
+
+class Model(object):
+
+    def __init__(self, qualifying):
+        self.Session = Session(qualifying)
+
+
+class TestDeleteRows(unittest.TestCase):
+
+    def setUp(self):
+        self.model, self.delete_ids = plan_module.model, plan_module.delete_ids
+        self.deleted = []
+
+        def delete_ids(ids, steps, throttle=None):
+            self.deleted.append(list(ids))
+            return {'resource': len(ids)}
+        plan_module.delete_ids = delete_ids
+
+    def tearDown(self):
+        plan_module.model, plan_module.delete_ids = self.model, self.delete_ids
+
+    def test_resources_that_no_longer_qualify_are_skipped(self):
+        plan_module.model = Model(['resource-1'])
+        plan = Plan('cleanup_resources')
+        plan.add_ids('resource', ['resource-1', 'resource-2'])
+        deleted_rows, skipped = plan.delete_rows()
+        self.assertEqual(self.deleted, [['resource-1']])
+        self.assertEqual(dict(deleted_rows), {'resource': 1})
+        self.assertEqual(dict(skipped), {'resource': ['resource-2']})
+
+    def test_nothing_is_deleted_if_no_resource_qualifies(self):
+        plan_module.model = Model([])
+        plan = Plan('cleanup_resources')
+        plan.add_ids('resource', ['resource-1'])
+        deleted_rows, skipped = plan.delete_rows()
+        self.assertEqual(self.deleted, [])
+        self.assertEqual(dict(deleted_rows), {})
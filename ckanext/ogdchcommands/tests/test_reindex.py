@@ -0,0 +1,54 @@
+# encoding: utf-8
+
+import unittest
+
+from ckanext.ogdchcommands import reindex
+from ckanext.ogdchcommands.reindex import remove_stale_entries
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.queries = []
+
+    def delete(self, q, commit):
+        self.queries.append((q, commit))
+
+
+class TestRemoveStaleEntries(unittest.TestCase):
+
+    def setUp(self):
+        self.originals = dict(
+            (name, getattr(reindex, name)) for name in (
+                'make_connection', 'iter_package_ids',
+                'iter_indexed_package_ids', 'commit', 'site_filter'))
+        self.connection = Connection()
+        self.commits = []
+        reindex.make_connection = lambda: self.connection
+        reindex.commit = lambda: self.commits.append(True)
+        reindex.site_filter = lambda: '+site_id:"test"'
+
+    def tearDown(self):
+        for name, value in self.originals.items():
+            setattr(reindex, name, value)
+
+    def _ids(self, db_ids, index_ids):
+        reindex.iter_package_ids = \
+            lambda rows, active_only: iter(db_ids)
+        reindex.iter_indexed_package_ids = \
+            lambda rows, active_only: iter(index_ids)
+
+    def test_entries_without_a_package_are_removed(self):
+        self._ids(['b', 'c'], ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(remove_stale_entries(batch_size=2), 3)
+        self.assertEqual(self.connection.queries, [
+            ('+site_id:"test" +id:("a" OR "d")', False),
+            ('+site_id:"test" +id:("e")', False),
+        ])
+        self.assertEqual(self.commits, [True])
+
+    def test_nothing_to_remove(self):
+        self._ids(['a', 'b'], ['a'])
+        self.assertEqual(remove_stale_entries(), 0)
+        self.assertEqual(self.connection.queries, [])
+        self.assertEqual(self.commits, [])
@@ -0,0 +1,90 @@
+# encoding: utf-8
+
+import threading
+import unittest
+
+from ckanext.ogdchcommands import search
+from ckanext.ogdchcommands.search import deferred_commits, merge_differences
+
+
+class TestDeferredCommits(unittest.TestCase):
+
+    def setUp(self):
+        self.config, self.commit = search.config, search.commit
+        self.commits = []
+        search.config = {'ckan.search.solr_commit': 'true'}
+        search.commit = lambda: self.commits.append(
+            search.config['ckan.search.solr_commit'])
+
+    def tearDown(self):
+        search.config, search.commit = self.config, self.commit
+
+    def test_commits_are_deferred_within_the_block(self):
+        with deferred_commits():
+            self.assertEqual(search.config['ckan.search.solr_commit'],
+                             'false')
+        self.assertEqual(search.config['ckan.search.solr_commit'], 'true')
+        self.assertEqual(self.commits, ['true'])
+
+    def test_nested_blocks_restore_the_setting(self):
+        with deferred_commits():
+            with deferred_commits():
+                pass
+            self.assertEqual(search.config['ckan.search.solr_commit'],
+                             'false')
+        self.assertEqual(search.config['ckan.search.solr_commit'], 'true')
+
+    def test_overlapping_blocks_restore_the_setting(self):
+        first_entered = threading.Event()
+        second_entered = threading.Event()
+
+        def first():
+            with deferred_commits():
+                first_entered.set()
+                second_entered.wait(5)
+
+        thread = threading.Thread(target=first)
+        thread.start()
+        first_entered.wait(5)
+        block = deferred_commits()
+        block.__enter__()
+        second_entered.set()
+        thread.join(5)
+        # the first block ended while the second one is still running
+        self.assertEqual(search.config['ckan.search.solr_commit'], 'false')
+        block.__exit__(None, None, None)
+        self.assertEqual(search.config['ckan.search.solr_commit'], 'true')
+
+    def test_setting_is_restored_on_errors(self):
+        def fail():
+            with deferred_commits():
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(search.config['ckan.search.solr_commit'], 'true')
+
+
+class TestMergeDifferences(unittest.TestCase):
+
+    def _merge(self, db_ids, index_ids, **kwargs):
+        return list(merge_differences(iter(db_ids), iter(index_ids),
+                                      **kwargs))
+
+    def test_differences(self):
+        self.assertEqual(
+            self._merge(['a', 'b', 'd', 'f'], ['b', 'c', 'd', 'e']),
+            [('a', None), (None, 'c'), (None, 'e'), ('f', None)])
+
+    def test_no_differences(self):
+        self.assertEqual(self._merge(['a', 'b'], ['a', 'b']), [])
+
+    def test_empty_sides(self):
+        self.assertEqual(self._merge([], ['a']), [(None, 'a')])
+        self.assertEqual(self._merge(['a'], []), [('a', None)])
+        self.assertEqual(self._merge([], []), [])
+
+    def test_progress_counts_merged_ids(self):
+        calls = []
+        self._merge(['a', 'b', 'c'], ['b', 'c', 'd', 'e'],
+                    progress=calls.append, interval=2)
+        # a, b, c, d and e have been merged
+        self.assertEqual(calls, [2, 4, 5])
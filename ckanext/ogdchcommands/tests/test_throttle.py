@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+import unittest
+
+from ckanext.ogdchcommands.throttle import (
+    get_throttle, Throttle, TokenBucket, MIN_BACKOFF)
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_no_wait_within_the_burst(self):
+        bucket = TokenBucket(rate=1000, burst=10)
+        self.assertEqual(bucket.take(10), 0)
+
+    def test_debt_is_waited_for(self):
+        bucket = TokenBucket(rate=1000, burst=10)
+        wait = bucket.take(20)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.01)
+
+    def test_burst_defaults_to_the_rate(self):
+        self.assertEqual(TokenBucket(rate=5).capacity, 5)
+
+
+class TestThrottle(unittest.TestCase):
+
+    def test_backoff_doubles_and_halves(self):
+        throttle = Throttle(latency_threshold=0.5)
+        self.assertEqual(throttle.observe(1), MIN_BACKOFF)
+        self.assertEqual(throttle.observe(1), MIN_BACKOFF * 2)
+        self.assertEqual(throttle.observe(0.1), 0)
+        self.assertEqual(throttle.backoff, MIN_BACKOFF)
+        throttle.observe(0.1)
+        self.assertEqual(throttle.backoff, 0)
+        # observing does not wait, the caller backs off
+        self.assertEqual(throttle.waited, 0)
+
+    def test_back_off(self):
+        throttle = Throttle(latency_threshold=0.5)
+        throttle.back_off(0.01)
+        throttle.back_off(0)
+        self.assertAlmostEqual(throttle.waited, 0.01)
+
+    def test_no_backoff_without_threshold(self):
+        throttle = Throttle(rows_per_second=1000)
+        self.assertEqual(throttle.observe(60), 0)
+        self.assertEqual(throttle.backoff, 0)
+        self.assertEqual(throttle.waited, 0)
+
+    def test_unlimited_rows_and_files(self):
+        throttle = Throttle(latency_threshold=0.5)
+        throttle.rows(10 ** 9)
+        throttle.files(10 ** 9)
+        self.assertEqual(throttle.waited, 0)
+
+
+class TestGetThrottle(unittest.TestCase):
+
+    def test_no_throttle_without_limits(self):
+        self.assertIsNone(get_throttle({}))
+
+    def test_limits_of_the_data_dict(self):
+        throttle = get_throttle({'rows_per_second': '100',
+                                 'latency_threshold_ms': '250'})
+        self.assertEqual(throttle.row_bucket.rate, 100)
+        self.assertIsNone(throttle.file_bucket)
+        self.assertEqual(throttle.latency_threshold, 0.25)
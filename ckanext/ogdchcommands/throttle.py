@@ -0,0 +1,128 @@
+# encoding: utf-8
+
+import logging
+import threading
+import time
+
+from ckan.common import config
+
+log = logging.getLogger(__name__)
+
+CONFIG_PREFIX = 'ckanext.ogdchcommands.throttle.'
+CHUNK_SIZE = 1000
+MIN_BACKOFF = 0.1
+MAX_BACKOFF = 30
+
+
+class TokenBucket(object):
+    """
+    a token bucket that is refilled with `rate` tokens per second up to
+    `burst` tokens: taking more tokens than there are blocks until they
+    have been refilled. The bucket may be shared by several threads.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        """
+        takes the tokens and returns the number of seconds waited for them
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the tokens are taken right away, later callers wait for
+            # the debt to be paid off as well
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Throttle(object):
+    """
+    limits the rows deleted per second and the files removed per second of
+    a cleanup, and backs off when the latency of the statements goes above
+    a threshold: the backoff doubles with every slow statement and halves
+    with every fast one
+    """
+
+    def __init__(self, rows_per_second=None, files_per_second=None,
+                 latency_threshold=None, chunk_size=CHUNK_SIZE):
+        self.row_bucket = \
+            TokenBucket(rows_per_second) if rows_per_second else None
+        self.file_bucket = \
+            TokenBucket(files_per_second) if files_per_second else None
+        self.latency_threshold = latency_threshold
+        self.chunk_size = chunk_size
+        self.backoff = 0
+        self.waited = 0
+        self._lock = threading.Lock()
+
+    def rows(self, count):
+        if self.row_bucket:
+            self._waited(self.row_bucket.take(count))
+
+    def files(self, count):
+        if self.file_bucket:
+            self._waited(self.file_bucket.take(count))
+
+    def observe(self, latency):
+        """
+        records the latency of a statement and returns the number of
+        seconds to back off for: the caller backs off with `back_off`
+        once its transaction is over, so that no locks are held meanwhile
+        """
+        if not self.latency_threshold:
+            return 0
+        with self._lock:
+            if latency > self.latency_threshold:
+                self.backoff = min(max(self.backoff * 2, MIN_BACKOFF),
+                                   MAX_BACKOFF)
+                log.debug('Statement took {:.3f}s: backing off for {:.1f}s'
+                          .format(latency, self.backoff))
+                return self.backoff
+            self.backoff = self.backoff / 2
+            if self.backoff < MIN_BACKOFF:
+                self.backoff = 0
+            return 0
+
+    def back_off(self, seconds):
+        if seconds:
+            time.sleep(seconds)
+            self._waited(seconds)
+
+    def _waited(self, seconds):
+        with self._lock:
+            self.waited += seconds
+
+
+def get_throttle(data_dict):
+    """
+    returns the throttle of a cleanup: the limits of the data_dict
+    override the ones in the config, there is no throttle if no limit is
+    set at all
+    """
+    def setting(name):
+        value = data_dict.get(name)
+        if value is None:
+            value = config.get(CONFIG_PREFIX + name)
+        return float(value) if value not in (None, '') else None
+
+    rows_per_second = setting('rows_per_second')
+    files_per_second = setting('files_per_second')
+    latency_threshold_ms = setting('latency_threshold_ms')
+    if rows_per_second is None and files_per_second is None \
+            and latency_threshold_ms is None:
+        return None
+    return Throttle(
+        rows_per_second, files_per_second,
+        latency_threshold_ms / 1000.0 if latency_threshold_ms else None,
+        int(config.get(CONFIG_PREFIX + 'chunk_size', CHUNK_SIZE)))